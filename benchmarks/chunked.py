@@ -0,0 +1,208 @@
+# Copyright (c) David Bern
+
+
+"""
+Compares the chunked transfer decoder of mitmtwisted with the copying
+decoder it replaced, on chunked bodies fed to them the way a transport
+would: in reads of --read-size bytes, or as one large read. Both decoders
+are checked to pass on the same raw data, payload and spill-over.
+
+Usage:
+    python benchmarks/chunked.py [--repeat 3] [--read-size 65536] [--digest]
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mitmtwisted import _RawChunkedTransferDecoder
+from gzip_encoder import make_body
+
+# name: (chunk sizes, read size or None for one read of the whole body)
+def cases(readSize):
+    rnd = random.Random(0)
+    tiny = [rnd.randint(1, 64) for _ in xrange(20000)]
+    small = [rnd.randint(512, 8192) for _ in xrange(2000)]
+    huge = [8 * 1024 * 1024] * 4
+    return [
+        ('tiny-chunks', tiny, readSize),
+        ('small-chunks', small, readSize),
+        ('huge-chunks', huge, readSize),
+        ('tiny-chunks-one-read', tiny, None),
+        ('huge-chunks-one-read', huge, None),
+    ]
+
+class CopyingChunkedDecoder(object):
+    """ The decoder as it was before it parsed received data in place """
+    state = 'CHUNK_LENGTH'
+    payloadCallback = None
+
+    def __init__(self, dataCallback, finishCallback):
+        self.dataCallback = dataCallback
+        self.finishCallback = finishCallback
+        self._buffer = ''
+
+    def _rawData(self, data):
+        self.dataCallback(data)
+
+    def _dataReceived_CHUNK_LENGTH(self, data):
+        if '\r\n' in data:
+            line, rest = data.split('\r\n', 1)
+            self._rawData(line+'\r\n')
+            parts = line.split(';')
+            self.length = int(parts[0], 16)
+            if self.length == 0:
+                self.state = 'TRAILER'
+            else:
+                self.state = 'BODY'
+            return rest
+        else:
+            self._buffer = data
+            return ''
+
+    def _dataReceived_CRLF(self, data):
+        if data.startswith('\r\n'):
+            self.state = 'CHUNK_LENGTH'
+            self._rawData('\r\n')
+            return data[2:]
+        else:
+            self._buffer = data
+            return ''
+
+    def _dataReceived_TRAILER(self, data):
+        if data.startswith('\r\n'):
+            self._rawData('\r\n')
+            data = data[2:]
+            self.state = 'FINISHED'
+            self.finishCallback(data)
+        else:
+            self._buffer = data
+        return ''
+
+    def _dataReceived_BODY(self, data):
+        if len(data) >= self.length:
+            chunk, data = data[:self.length], data[self.length:]
+            self._rawData(chunk)
+            if self.payloadCallback is not None:
+                self.payloadCallback(chunk)
+            self.state = 'CRLF'
+            return data
+        elif len(data) < self.length:
+            self.length -= len(data)
+            self._rawData(data)
+            if self.payloadCallback is not None:
+                self.payloadCallback(data)
+            return ''
+
+    def dataReceived(self, data):
+        data = self._buffer + data
+        self._buffer = ''
+        while data:
+            data = getattr(self, '_dataReceived_%s' % (self.state,))(data)
+
+DECODERS = [
+    ('copying', CopyingChunkedDecoder),
+    ('in-place', _RawChunkedTransferDecoder),
+]
+
+def chunked_body(sizes):
+    """ A chunked body with the given chunk sizes, and some spill-over """
+    data = make_body(max(sizes))
+    parts = []
+    for size in sizes:
+        parts.append('%x\r\n' % size)
+        parts.append(data[:size])
+        parts.append('\r\n')
+    parts.append('0\r\n\r\nHTTP/1.1 200 OK\r\n')
+    return ''.join(parts)
+
+def reads(body, readSize):
+    if readSize is None:
+        return [body]
+    return [body[i:i + readSize] for i in xrange(0, len(body), readSize)]
+
+"""
+Receives what a decoder passes on. By default only the lengths are counted,
+which times the decoder alone. With digest, the raw data and payload are
+hashed like the proxy does for the WARC record.
+
+"""
+class Sink(object):
+    def __init__(self, digest):
+        self.raw = 0
+        self.payload = 0
+        self.rest = None
+        self.rawHash = hashlib.sha1() if digest else None
+        self.payloadHash = hashlib.sha1() if digest else None
+
+    def rawData(self, data):
+        self.raw += len(data)
+        if self.rawHash is not None:
+            self.rawHash.update(data)
+
+    def payloadData(self, data):
+        self.payload += len(data)
+        if self.payloadHash is not None:
+            self.payloadHash.update(data)
+
+    def finished(self, rest):
+        self.rest = rest
+
+    def result(self):
+        return (self.raw, self.payload, self.rest,
+                self.rawHash and self.rawHash.hexdigest(),
+                self.payloadHash and self.payloadHash.hexdigest())
+
+def decode(cls, data, digest):
+    sink = Sink(digest)
+    decoder = cls(sink.rawData, sink.finished)
+    decoder.payloadCallback = sink.payloadData
+    for read in data:
+        if sink.rest is not None:
+            # The parser takes over once the body has ended
+            break
+        decoder.dataReceived(read)
+    return sink
+
+def best_time(cls, data, digest, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        decode(cls, data, digest)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Chunked decoder benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per case. The fastest is reported')
+    parser.add_argument('--read-size', type=int, default=65536,
+                        help='Bytes passed to each dataReceived call')
+    parser.add_argument('--digest', action='store_true',
+                        help='Hash the decoded data, as the proxy does')
+    args = parser.parse_args()
+
+    print "%-22s %8s %8s %12s %12s %8s" % ('case', 'chunks', 'MB',
+            'copying MB/s', 'in-place MB/s', 'speedup')
+    for name, sizes, readSize in cases(args.read_size):
+        body = chunked_body(sizes)
+        data = reads(body, readSize)
+        results = [decode(cls, data, True).result() for _, cls in DECODERS]
+        if results[0] != results[1]:
+            raise AssertionError("%s: the decoders disagree" % name)
+        mb = len(body) / 1048576.0
+        rates = [mb / best_time(cls, data, args.digest, args.repeat)
+                 for _, cls in DECODERS]
+        print "%-22s %8d %8.1f %12.1f %12.1f %7.1fx" % (name, len(sizes), mb,
+                rates[0], rates[1], rates[1] / rates[0])
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Copyright (c) David Bern
+
+
+"""
+Measures how CompressorPool throughput grows with its number of threads.
+Each case encodes the same records into gzip members, either with
+zlib.compress (members that fit in one chunk) or through a compressobj
+(chunks smaller than the records). Python 2's zlib module serializes
+compressobj calls on one lock, so only the first can use more than one
+core. The cores column is CPU time over wall time: how many cores the
+pool kept busy. Speedups need a machine with that many free cores.
+
+Usage:
+    python benchmarks/compress_threads.py [--size 262144] [--records 400]
+                                          [--max-threads 8] [--level 6]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import warcrecords
+from warcwriter import CompressorPool
+from hanzo.warctools.record import GzipRecordEncoder
+from gzip_encoder import make_body
+
+def records(count, size):
+    body = make_body(size)
+    return [warcrecords.WarcResponseRecord(url='http://example.com/%d' % n,
+                                           block=body)
+            for n in xrange(count)]
+
+def run(threads, encoder, batch):
+    pool = CompressorPool(threads, encoder)
+    pool.start()
+    cpu = sum(os.times()[:2])
+    start = time.time()
+    jobs = [pool.submit(record) for record in batch]
+    written = 0
+    for job in jobs:
+        job.done.wait()
+        if job.failure is not None:
+            job.failure.raiseException()
+        written += len(job.member)
+        job.member.close()
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu
+    pool.stop()
+    return elapsed, cpu, written
+
+def main():
+    parser = argparse.ArgumentParser(description='Compressor pool scaling')
+    parser.add_argument('--size', type=int, default=256 * 1024,
+                        help='Bytes in each record body')
+    parser.add_argument('--records', type=int, default=400)
+    parser.add_argument('--max-threads', type=int, default=8)
+    parser.add_argument('--level', type=int, default=6)
+    args = parser.parse_args()
+
+    batch = records(args.records, args.size)
+    mb = args.records * args.size / 1048576.0
+    modes = [
+        ('zlib.compress', GzipRecordEncoder(level=args.level)),
+        # Chunks smaller than the records force the compressobj path
+        ('compressobj', GzipRecordEncoder(level=args.level,
+                                          chunk_size=args.size // 4)),
+    ]
+    print "%d CPUs, %d records of %d bytes" % (multiprocessing.cpu_count(),
+                                              args.records, args.size)
+    print "%-14s %8s %10s %8s %8s" % ('mode', 'threads', 'MB/s', 'speedup',
+                                      'cores')
+    threads = [n for n in (1, 2, 4, 8, 16, 32) if n <= args.max_threads]
+    for name, encoder in modes:
+        base = None
+        for n in threads:
+            elapsed, cpu, _ = run(n, encoder, batch)
+            rate = mb / elapsed
+            base = base or rate
+            print "%-14s %8d %10.1f %7.2fx %8.2f" % (name, n, rate,
+                                                    rate / base, cpu / elapsed)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
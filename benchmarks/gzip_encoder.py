@@ -0,0 +1,97 @@
+# Copyright (c) David Bern
+
+
+"""
+Compares writing record-gzipped WARC records through a GzipFile per record
+with GzipRecordEncoder.
+
+Usage:
+    python benchmarks/gzip_encoder.py [--level 6] [--total 104857600]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from gzip import GzipFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import warcrecords
+from hanzo.warctools.record import GzipRecordEncoder
+
+SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024,
+         100 * 1024 * 1024]
+
+class NullSink(object):
+    """ Counts the bytes written to it """
+    def __init__(self):
+        self.written = 0
+        self.mode = 'wb'
+    def write(self, data):
+        self.written += len(data)
+    def flush(self):
+        pass
+
+def make_body(size, seed=0):
+    """ Deterministic, moderately compressible text of the given size """
+    rnd = random.Random(seed)
+    words = [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz')
+                     for _ in xrange(rnd.randint(2, 10))) for _ in xrange(500)]
+    block = []
+    length = 0
+    while length < min(size, 1024 * 1024):
+        word = rnd.choice(words)
+        block.append(word)
+        length += len(word) + 1
+    block = ' '.join(block)
+    body = block * (size // len(block) + 1)
+    return 'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n' + body[:size]
+
+def write_gzipfile(record, out, level):
+    """ The per-record GzipFile path ArchiveRecord.write_to used to take """
+    gz = GzipFile(fileobj=out, mode='wb', compresslevel=level)
+    record._write_to(gz, '\r\n')
+    gz.flush()
+    gz.close()
+
+def write_encoder(encoder):
+    def write(record, out, level):
+        record.write_to(out, gzip=True, encoder=encoder)
+    return write
+
+def run(write, record, repeat, level):
+    sink = NullSink()
+    start = time.time()
+    for _ in xrange(repeat):
+        write(record, sink, level)
+    return time.time() - start, sink.written
+
+def main():
+    parser = argparse.ArgumentParser(description='Record gzip microbenchmark')
+    parser.add_argument('--level', type=int, default=9)
+    parser.add_argument('--total', type=int, default=100 * 1024 * 1024,
+                        help='Approximate bytes to compress per record size')
+    parser.add_argument('--max-size', type=int, default=SIZES[-1])
+    args = parser.parse_args()
+
+    encoder = GzipRecordEncoder(level=args.level)
+    print "%10s %8s %12s %12s %12s %8s" % ('size', 'records', 'gzipfile MB/s',
+                                          'encoder MB/s', 'out bytes', 'speedup')
+    for size in SIZES:
+        if size > args.max_size:
+            break
+        record = warcrecords.WarcResponseRecord(url='http://example.com/',
+                                                block=make_body(size))
+        repeat = max(1, args.total // size)
+        old_time, old_out = run(write_gzipfile, record, repeat, args.level)
+        new_time, new_out = run(write_encoder(encoder), record, repeat,
+                                args.level)
+        mb = float(size * repeat) / (1024 * 1024)
+        print "%10d %8d %12.1f %12.1f %12d %7.2fx" % (size, repeat,
+                mb / old_time, mb / new_time, new_out // repeat,
+                old_time / new_time)
+
+if __name__ == '__main__':
+    main()
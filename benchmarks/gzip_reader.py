@@ -0,0 +1,96 @@
+# Copyright (c) David Bern
+
+
+"""
+Compares reading every line of a record-gzipped WARC through
+GzipRecordFile with inflating the same members with zlib alone.
+
+Usage:
+    python benchmarks/gzip_reader.py [--records 2000] [--size 262144]
+    python benchmarks/gzip_reader.py --file crawl.warc.gz
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import warcrecords
+from hanzo.warctools.record import GzipRecordEncoder
+from hanzo.warctools.stream import GzipRecordFile
+from gzip_encoder import make_body
+
+def build_file(path, records, size):
+    encoder = GzipRecordEncoder(level=6)
+    body = make_body(size)
+    with open(path, 'wb') as out:
+        for n in xrange(records):
+            record = warcrecords.WarcResponseRecord(
+                            url='http://example.com/%d' % n, block=body)
+            record.write_to(out, gzip=True, encoder=encoder)
+
+def inflate_only(path, chunk_size):
+    """ Decompresses every member and throws the data away """
+    total = 0
+    with open(path, 'rb') as fh:
+        data = fh.read(chunk_size)
+        z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while data:
+            total += len(z.decompress(data))
+            data = z.unused_data or fh.read(chunk_size)
+            if z.unused_data:
+                z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return total
+
+def readlines(path, chunk_size):
+    """ Reads every line of every member through GzipRecordFile """
+    total = 0
+    with open(path, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        while fh.tell() < size:
+            gz = GzipRecordFile(fh, chunk_size)
+            line = gz.readline()
+            while line:
+                total += len(line)
+                line = gz.readline()
+    return total
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='GzipRecordFile benchmark')
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=256 * 1024,
+                        help='Response size of the generated records')
+    parser.add_argument('--file', default=None,
+                        help='Read this WARC instead of generating one')
+    parser.add_argument('--chunk-size', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    path = args.file
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.warc.gz')
+        os.close(fd)
+        build_file(path, args.records, args.size)
+    try:
+        inflated, zlib_time = timed(inflate_only, path, args.chunk_size)
+        read, read_time = timed(readlines, path, args.chunk_size)
+    finally:
+        if args.file is None:
+            os.unlink(path)
+    assert read == inflated, (read, inflated)
+    mb = inflated / 1048576.0
+    print "%.1f MB inflated" % mb
+    print "zlib only        %8.1f MB/s" % (mb / zlib_time)
+    print "GzipRecordFile   %8.1f MB/s" % (mb / read_time)
+    print "relative speed   %8.2f" % (zlib_time / read_time)
+
+if __name__ == '__main__':
+    main()
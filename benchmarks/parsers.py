@@ -0,0 +1,302 @@
+# Copyright (c) David Bern
+
+
+"""
+Times hanzo.warctools over deterministic synthetic corpora: many small
+WARC records, a few huge ones, record-gzipped and whole-file gzipped
+WARCs, and ARC v1 and v2 files. For each corpus it times a full parse,
+a header-only scan (lazy content, WARC only) and a parse and write round
+trip (WARC only). It reports records/s and MB/s, counting the archive's
+uncompressed size so gzipped and plain corpora compare.
+
+Corpora are generated in --dir the first time and reused afterwards.
+Results can be saved with --output and compared with a saved run with
+--baseline, which exits with status 1 if anything got slower than
+--tolerance allows.
+
+Usage:
+    python benchmarks/parsers.py [--scale 1.0] [--repeat 3]
+                                 [--output results.json]
+    python benchmarks/parsers.py --baseline results.json
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import warcrecords
+from hanzo.warctools import WarcRecord, ArcRecord
+from hanzo.warctools.record import GzipRecordEncoder
+from gzip_encoder import make_body, NullSink
+
+DATE = '2014-01-01T00:00:00Z'
+ARC_DATE = '20140101000000'
+
+# name: (format, records, body size, gzip). Record counts are multiplied
+# by --scale
+CORPORA = [
+    ('warc-small', ('warc', 20000, 2048, None)),
+    ('warc-small-record-gz', ('warc', 20000, 2048, 'record')),
+    ('warc-small-file-gz', ('warc', 20000, 2048, 'file')),
+    ('warc-huge', ('warc', 4, 32 * 1024 * 1024, None)),
+    ('warc-huge-record-gz', ('warc', 4, 32 * 1024 * 1024, 'record')),
+    ('arc1-small', ('arc1', 20000, 2048, None)),
+    ('arc2-small', ('arc2', 20000, 2048, None)),
+    ('arc2-small-record-gz', ('arc2', 20000, 2048, 'record')),
+]
+
+ARC_FIELDS = {
+    'arc1': 'URL IP-address Archive-date Content-type Archive-length',
+    'arc2': 'URL IP-address Archive-date Content-type Result-code Checksum '
+            'Location Offset Filename Archive-length',
+}
+
+def warc_records(count, size, seed):
+    rnd = random.Random(seed)
+    bodies = [make_body(max(1, int(size * f)), seed) for f in (0.5, 1, 1.5)]
+    for n in xrange(count):
+        yield warcrecords.WarcResponseRecord(
+                    id='<urn:uuid:%s>' % uuid.UUID(int=rnd.getrandbits(128)),
+                    date=DATE, url='http://example.com/%d' % n,
+                    block=rnd.choice(bodies))
+
+def arc_records(version, count, size, seed, filename):
+    """ Yields the raw ARC records, starting with the filedesc """
+    rnd = random.Random(seed)
+    bodies = [make_body(max(1, int(size * f)), seed) for f in (0.5, 1, 1.5)]
+    fields = ARC_FIELDS[version]
+    desc = '%s 0 warcmitm\n%s\n' % ('1' if version == 'arc1' else '2',
+                                     fields)
+    if version == 'arc1':
+        head = 'filedesc://%s 0.0.0.0 %s text/plain %d\n' % (filename,
+                    ARC_DATE, len(desc))
+    else:
+        head = 'filedesc://%s 0.0.0.0 %s text/plain 200 0 - 0 %s %d\n' % (
+                    filename, ARC_DATE, filename, len(desc))
+    filedesc = head + desc + '\n'
+    yield filedesc
+    # Offset of the record in the uncompressed file
+    offset = len(filedesc)
+    for n in xrange(count):
+        body = rnd.choice(bodies)
+        url = 'http://example.com/%d' % n
+        if version == 'arc1':
+            head = '%s 10.0.0.1 %s text/plain %d\n' % (url, ARC_DATE,
+                                                       len(body))
+        else:
+            head = '%s 10.0.0.1 %s text/plain 200 %032x - %d %s %d\n' % (
+                        url, ARC_DATE, n, offset, filename, len(body))
+        record = head + body + '\n'
+        offset += len(record)
+        yield record
+
+def gzip_member(data):
+    out = StringIO()
+    gz = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+    gz.write(data)
+    gz.close()
+    return out.getvalue()
+
+def build_corpus(path, format, count, size, compression, seed=0):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as out:
+        if compression == 'file':
+            fo = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+        else:
+            fo = out
+        if format == 'warc':
+            encoder = GzipRecordEncoder(level=6)
+            for record in warc_records(count, size, seed):
+                record.write_to(fo, gzip=compression == 'record',
+                                encoder=encoder)
+        else:
+            for data in arc_records(format, count, size, seed,
+                                    os.path.basename(path)):
+                fo.write(gzip_member(data) if compression == 'record'
+                         else data)
+        if fo is not out:
+            fo.close()
+    os.rename(tmp, path)
+
+def archive_size(path, compression):
+    """ Size of the archive once any gzip is inflated """
+    if compression is None:
+        return os.path.getsize(path)
+    size = 0
+    gz = gzip.GzipFile(path, 'rb')
+    data = gz.read(1024 * 1024)
+    while data:
+        size += len(data)
+        data = gz.read(1024 * 1024)
+    gz.close()
+    return size
+
+def open_stream(path, format, compression, lazy=False, mmap=False):
+    cls = WarcRecord if format == 'warc' else ArcRecord
+    return cls.open_archive(filename=path, mode='rb', gzip=compression,
+                            lazy=lazy, mmap=mmap)
+
+def parse(path, format, compression):
+    """ Reads every record and its content """
+    records = 0
+    stream = open_stream(path, format, compression)
+    for _, record, errors in stream.read_records(limit=None):
+        if record is None:
+            break
+        if record.errors or errors:
+            raise StandardError('%s: %r' % (path, record.errors or errors))
+        len(record.content[1])
+        records += 1
+    stream.close()
+    return records
+
+def parse_mmap(path, format, compression):
+    records = 0
+    stream = open_stream(path, format, compression, mmap=True)
+    for _, record, _ in stream.read_records(limit=None):
+        if record is None:
+            break
+        len(record.content[1])
+        records += 1
+    stream.close()
+    return records
+
+def scan(path, format, compression):
+    """ Reads headers only. The content is skipped, not read """
+    records = 0
+    stream = open_stream(path, format, compression, lazy=True)
+    for _, record, _ in stream.read_records(limit=None):
+        if record is None:
+            break
+        record.url, record.type
+        records += 1
+    stream.close()
+    return records
+
+def round_trip(path, format, compression):
+    """ Parses every record and writes it out again the same way """
+    records = 0
+    sink = NullSink()
+    encoder = GzipRecordEncoder(level=6)
+    stream = open_stream(path, format, compression)
+    for _, record, _ in stream.read_records(limit=None):
+        if record is None:
+            break
+        record.write_to(sink, gzip=compression is not None, encoder=encoder)
+        records += 1
+    stream.close()
+    return records
+
+def operations(format, compression):
+    yield 'parse', parse
+    if format == 'warc':
+        if compression is None:
+            yield 'parse-mmap', parse_mmap
+        yield 'scan', scan
+        yield 'write', round_trip
+
+def best_time(function, args, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+def compare(results, baseline, tolerance):
+    """ Prints the change from baseline, returns the number of regressions """
+    old = dict(((r['corpus'], r['operation']), r) for r in baseline)
+    regressions = 0
+    for result in results:
+        before = old.get((result['corpus'], result['operation']))
+        if before is None:
+            continue
+        ratio = result['mb_per_second'] / before['mb_per_second']
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        print "%-22s %-10s %8.1f -> %8.1f MB/s %6.2fx %s" % (
+                result['corpus'], result['operation'],
+                before['mb_per_second'], result['mb_per_second'], ratio, flag)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Parser benchmarks')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies the record counts of the corpora')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per case. The fastest is reported')
+    parser.add_argument('--corpus', action='append', default=None,
+                        choices=[name for name, _ in CORPORA],
+                        help='Run only this corpus. Repeatable')
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(),
+                                                      'warcmitm-bench'))
+    parser.add_argument('--output', default=None,
+                        help='Save the results as JSON')
+    parser.add_argument('--baseline', default=None,
+                        help='Compare with results saved by --output')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Slowdown that counts as a regression')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    results = []
+    print "%-22s %-10s %8s %10s %12s %10s" % ('corpus', 'operation',
+            'records', 'MB', 'records/s', 'MB/s')
+    for name, (format, count, size, compression) in CORPORA:
+        if args.corpus and name not in args.corpus:
+            continue
+        count = max(1, int(count * args.scale))
+        path = os.path.join(args.dir, 'parsers-%s-%d.%s%s' % (name, count,
+                            'warc' if format == 'warc' else 'arc',
+                            '.gz' if compression else ''))
+        if not os.path.exists(path):
+            build_corpus(path, format, count, size, compression)
+        size = archive_size(path, compression)
+        mb = size / 1048576.0
+        for operation, function in operations(format, compression):
+            records, elapsed = best_time(function,
+                                         (path, format, compression),
+                                         args.repeat)
+            result = {
+                'corpus': name,
+                'operation': operation,
+                'records': records,
+                'bytes': size,
+                'file_bytes': os.path.getsize(path),
+                'seconds': round(elapsed, 4),
+                'records_per_second': round(records / elapsed, 1),
+                'mb_per_second': round(mb / elapsed, 2),
+            }
+            results.append(result)
+            print "%-22s %-10s %8d %10.1f %12.0f %10.1f" % (name, operation,
+                    records, mb, result['records_per_second'],
+                    result['mb_per_second'])
+            sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+# Copyright (c) David Bern
+
+
+"""
+Drives warcmitm.py end to end. Starts a local HTTP/HTTPS origin stand-in
+and the proxy as separate processes, sends requests through the proxy from
+--concurrency clients and prints the results as JSON: requests/s, MB/s,
+p50/p99 latency, proxy CPU time and proxy peak RSS.
+
+The origin serves ?size=N bytes, with chunk=M as M-byte chunks of a
+chunked response instead of a Content-Length.
+
+Usage:
+    python benchmarks/proxy_e2e.py [--requests 2000] [--concurrency 20]
+                                   [--size 16384] [--chunked 4096] [--https]
+                                   [--no-keepalive] [--output result.json]
+                                   [--proxy-arg=--compress-level=1]
+    python benchmarks/proxy_e2e.py --all --output results.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.internet import reactor, protocol, ssl, defer
+from twisted.web import server, resource as webresource
+from twisted.web.http_headers import Headers
+from twisted.web._newclient import (HTTP11ClientProtocol, Request,
+                                    ResponseDone, PotentialDataLoss)
+
+from gzip_encoder import make_body
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Scenarios run by --all. Each is a set of overrides of the defaults
+SCENARIOS = [
+    ('small', dict(size=1024)),
+    ('small-close', dict(size=1024, keepalive=False)),
+    ('medium', dict(size=64 * 1024)),
+    ('large', dict(size=4 * 1024 * 1024, requests=200)),
+    ('chunked', dict(size=256 * 1024, chunked=1024)),
+    ('small-https', dict(size=1024, https=True)),
+    ('medium-https', dict(size=64 * 1024, https=True)),
+    ('small-https-close', dict(size=1024, https=True, keepalive=False)),
+]
+
+class OriginResource(webresource.Resource):
+    """ Serves ?size=N bytes, in chunk=M byte chunks if given """
+    isLeaf = True
+
+    def __init__(self):
+        webresource.Resource.__init__(self)
+        self.bodies = {}
+
+    def body(self, size):
+        if size not in self.bodies:
+            self.bodies[size] = make_body(size)
+        return self.bodies[size]
+
+    def render_GET(self, request):
+        body = self.body(int(request.args.get('size', ['1024'])[0]))
+        request.setHeader('content-type', 'text/plain')
+        chunk = int(request.args.get('chunk', ['0'])[0])
+        if not chunk:
+            request.setHeader('content-length', str(len(body)))
+            return body
+        for start in xrange(0, len(body), chunk):
+            request.write(body[start:start + chunk])
+        request.finish()
+        return server.NOT_DONE_YET
+
+@defer.inlineCallbacks
+def serveOrigin():
+    """ Runs in the origin process. Prints the HTTP and HTTPS ports """
+    from certauth import CertificateAuthority
+    site = server.Site(OriginResource())
+    site.log = lambda request: None
+    ca = CertificateAuthority(os.path.join(ROOT, 'ca.key'),
+                              os.path.join(ROOT, 'ca.crt'))
+    context = yield ca.getContextFactory('localhost')
+    http = reactor.listenTCP(0, site, interface='127.0.0.1')
+    https = reactor.listenSSL(0, site, context, interface='127.0.0.1')
+    print http.getHost().port, https.getHost().port
+    sys.stdout.flush()
+
+def freePort():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def waitForPort(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('proxy exited with %d' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('proxy did not start listening on %d' % port)
+
+def cpuSeconds(pid):
+    """ utime + stime of pid from /proc, or None where there is no /proc """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / \
+           float(os.sysconf('SC_CLK_TCK'))
+
+class BodyCounter(protocol.Protocol):
+    def __init__(self, finished):
+        self.finished = finished
+        self.length = 0
+
+    def dataReceived(self, data):
+        self.length += len(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.length)
+        else:
+            self.finished.errback(reason)
+
+class TunnelProtocol(protocol.Protocol):
+    """
+    Sends CONNECT to the proxy, starts TLS once the proxy accepts it and
+    then passes the connection on to an HTTP11ClientProtocol
+
+    """
+    def __init__(self, target, ready):
+        self.target = target
+        self.ready = ready
+        self.buffer = ''
+        self.client = None
+
+    def connectionMade(self):
+        self.transport.write('CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n' %
+                             (self.target, self.target))
+
+    def dataReceived(self, data):
+        if self.client is not None:
+            self.client.dataReceived(data)
+            return
+        self.buffer += data
+        if '\r\n\r\n' not in self.buffer:
+            return
+        if self.buffer.split(' ', 2)[1] != '200':
+            self.transport.loseConnection()
+            self.ready.errback(RuntimeError('CONNECT failed: %r' %
+                                            self.buffer.split('\r\n')[0]))
+            return
+        self.transport.startTLS(ssl.ClientContextFactory())
+        self.client = HTTP11ClientProtocol()
+        self.client.makeConnection(self.transport)
+        self.ready.callback(self.client)
+
+    def connectionLost(self, reason):
+        if self.client is not None:
+            self.client.connectionLost(reason)
+        elif not self.ready.called:
+            self.ready.errback(reason)
+
+class LoadGenerator(object):
+    """ Sends requests requests through the proxy from concurrency clients """
+    def __init__(self, proxyPort, originPort, options):
+        self.proxyPort = proxyPort
+        self.options = options
+        self.remaining = options.requests
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        query = '/?size=%d' % options.size
+        if options.chunked:
+            query += '&chunk=%d' % options.chunked
+        self.target = 'localhost:%d' % originPort
+        if options.https:
+            self.uri = query
+        else:
+            self.uri = 'http://%s%s' % (self.target, query)
+        self.headers = Headers({'host': [self.target]})
+
+    def connect(self):
+        creator = protocol.ClientCreator(reactor, HTTP11ClientProtocol)
+        if not self.options.https:
+            return creator.connectTCP('127.0.0.1', self.proxyPort)
+        ready = defer.Deferred()
+        creator = protocol.ClientCreator(reactor, TunnelProtocol,
+                                         self.target, ready)
+        d = creator.connectTCP('127.0.0.1', self.proxyPort)
+        d.addErrback(ready.errback)
+        return ready
+
+    @defer.inlineCallbacks
+    def client(self):
+        client = None
+        while self.remaining > 0:
+            self.remaining -= 1
+            started = time.time()
+            try:
+                if client is None or client.state != 'QUIESCENT':
+                    client = yield self.connect()
+                response = yield client.request(Request('GET', self.uri,
+                                    self.headers, None,
+                                    persistent=self.options.keepalive))
+                finished = defer.Deferred()
+                response.deliverBody(BodyCounter(finished))
+                length = yield finished
+            except Exception:
+                self.errors += 1
+                if client is not None:
+                    client.transport.loseConnection()
+                client = None
+                continue
+            self.latencies.append(time.time() - started)
+            self.bytes += length
+            if not self.options.keepalive:
+                client.transport.loseConnection()
+                client = None
+        if client is not None:
+            client.transport.loseConnection()
+
+    def run(self):
+        return defer.DeferredList([self.client() for _ in
+                                   xrange(self.options.concurrency)])
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+@defer.inlineCallbacks
+def runScenario(name, options, originPorts):
+    """ Runs one scenario against a fresh proxy and returns its results """
+    directory = tempfile.mkdtemp(prefix='warcmitm-e2e-')
+    proxyPort = freePort()
+    devnull = open(os.devnull, 'w')
+    proxy = subprocess.Popen([sys.executable, 'warcmitm.py',
+                              '-p', str(proxyPort),
+                              '-f', os.path.join(directory, 'out.warc.gz')] +
+                             options.proxy_arg, cwd=ROOT, stdout=devnull,
+                             stderr=devnull)
+    try:
+        waitForPort(proxyPort, proxy)
+        load = LoadGenerator(proxyPort, originPorts[options.https], options)
+        cpuBefore = cpuSeconds(proxy.pid)
+        started = time.time()
+        yield load.run()
+        elapsed = time.time() - started
+        cpuAfter = cpuSeconds(proxy.pid)
+    finally:
+        if proxy.poll() is None:
+            proxy.terminate()
+        # wait4 gives the proxy's own rusage, so CPU and RSS are not mixed
+        # up with the origin's
+        _, _, usage = os.wait4(proxy.pid, 0)
+        devnull.close()
+    if cpuBefore is not None and cpuAfter is not None:
+        cpu = cpuAfter - cpuBefore
+    else:
+        cpu = usage.ru_utime + usage.ru_stime
+    warcBytes = sum(os.path.getsize(os.path.join(directory, f))
+                    for f in os.listdir(directory))
+    shutil.rmtree(directory)
+
+    latencies = sorted(load.latencies)
+    done = len(latencies)
+    result = {
+        'scenario': name,
+        'size': options.size,
+        'chunked': options.chunked,
+        'https': options.https,
+        'keepalive': options.keepalive,
+        'concurrency': options.concurrency,
+        'proxy_args': options.proxy_arg,
+        'requests': done,
+        'errors': load.errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(done / elapsed, 1),
+        'mb_per_second': round(load.bytes / 1048576.0 / elapsed, 2),
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2)
+                          if done else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2)
+                          if done else None,
+        'proxy_cpu_seconds': round(cpu, 3),
+        'proxy_cpu_percent': round(100 * cpu / elapsed, 1),
+        # ru_maxrss is in kilobytes on Linux
+        'proxy_peak_rss_mb': round(usage.ru_maxrss / 1024.0, 1),
+        'warc_bytes': warcBytes,
+    }
+    print >> sys.stderr, "%-18s %8.1f req/s %8.2f MB/s  p50 %7.2f ms  " \
+            "p99 %7.2f ms  cpu %5.1f%%  rss %6.1f MB  errors %d" % (name,
+            result['requests_per_second'], result['mb_per_second'],
+            result['latency_p50_ms'] or 0, result['latency_p99_ms'] or 0,
+            result['proxy_cpu_percent'], result['proxy_peak_rss_mb'],
+            load.errors)
+    defer.returnValue(result)
+
+@defer.inlineCallbacks
+def main(args):
+    origin = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               '--serve-origin'], cwd=ROOT,
+                              stdout=subprocess.PIPE)
+    try:
+        http, https = [int(p) for p in origin.stdout.readline().split()]
+        originPorts = {False: http, True: https}
+        if args.all:
+            scenarios = []
+            for name, overrides in SCENARIOS:
+                options = argparse.Namespace(**vars(args))
+                for key, value in overrides.items():
+                    setattr(options, key, value)
+                scenarios.append((name, options))
+        else:
+            scenarios = [(args.name, args)]
+        results = []
+        for name, options in scenarios:
+            result = yield runScenario(name, options, originPorts)
+            results.append(result)
+        output = json.dumps(results if args.all else results[0], indent=2,
+                            sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print output
+    finally:
+        origin.terminate()
+        origin.wait()
+        reactor.stop()
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Proxy end to end benchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--size', type=int, default=16384,
+                        help='Response body size in bytes')
+    parser.add_argument('--chunked', type=int, default=0,
+                        help='Send the body chunked, in chunks of this size')
+    parser.add_argument('--https', action='store_true',
+                        help='Request through CONNECT and TLS')
+    parser.add_argument('--no-keepalive', dest='keepalive',
+                        action='store_false',
+                        help='Open a new connection for every request')
+    parser.add_argument('--proxy-arg', action='append', default=[],
+                        help='Extra argument for warcmitm.py. Repeatable')
+    parser.add_argument('--name', default='custom',
+                        help='Scenario name in the output')
+    parser.add_argument('--all', action='store_true',
+                        help='Run the built-in scenarios instead')
+    parser.add_argument('--output', default=None,
+                        help='Write the JSON here instead of stdout')
+    parser.add_argument('--serve-origin', action='store_true',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parseArgs()
+    if args.serve_origin:
+        reactor.callWhenRunning(serveOrigin)
+    else:
+        # Clients, proxy connections and origin sockets can add up
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        reactor.callWhenRunning(main, args)
+    reactor.run()
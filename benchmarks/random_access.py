@@ -0,0 +1,103 @@
+# Copyright (c) David Bern
+
+
+"""
+Looks up random records listed in a CDXJ index, with a seek and
+read_records on a GzipRecordStream and with read_record_at. Reports
+lookups per second for both.
+
+A corpus of record-gzipped response records is generated in --dir the
+first time and reused afterwards.
+
+Usage:
+    python benchmarks/random_access.py [--records 20000] [--lookups 2000]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import warcrecords
+from hanzo.warctools import WarcRecord
+from hanzo.warctools.record import GzipRecordEncoder
+from warcwriter import WarcOutputFile
+from gzip_encoder import make_body
+
+def build_corpus(path, records, seed=0):
+    rnd = random.Random(seed)
+    output = WarcOutputFile(path, GzipRecordEncoder(level=6), cdxj=True)
+    fo = output.file()
+    bodies = [make_body(size, seed) for size in (512, 4096, 32768, 262144)]
+    for n in xrange(records):
+        body = rnd.choice(bodies)
+        record = warcrecords.WarcResponseRecord(
+                            url='http://example.com/%d' % n, block=body)
+        offset = fo.tell()
+        record.write_to(fo, gzip=True, encoder=output.encoder)
+        output.indexRecord(record, offset, fo.tell() - offset)
+    output.close()
+
+def load_index(path):
+    entries = []
+    with open(path) as f:
+        for line in f:
+            fields = json.loads(line.split(' ', 2)[2])
+            entries.append((fields['url'], int(fields['offset']),
+                            int(fields['length'])))
+    return entries
+
+def seek_and_read(fh, offset, length):
+    """ What finding a record took before read_record_at """
+    stream = WarcRecord.open_archive(file_handle=fh, gzip='record')
+    stream.seek(offset)
+    for _, record, _ in stream.read_records(limit=1):
+        return record
+
+def read_at(stream):
+    def read(fh, offset, length):
+        return stream.read_record_at(offset, length)
+    return read
+
+def run(read, fh, lookups):
+    start = time.time()
+    for url, offset, length in lookups:
+        record = read(fh, offset, length)
+        assert record.url == url, (record.url, url)
+    return len(lookups) / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Random access benchmark')
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(),
+                                                      'warcmitm-bench'))
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    path = os.path.join(args.dir, 'corpus-%d.warc.gz' % args.records)
+    if not os.path.exists(path + '.cdxj'):
+        print "Writing", args.records, "records to", path
+        build_corpus(path, args.records)
+    entries = load_index(path + '.cdxj')
+    print "%d records, %.1f MB" % (len(entries),
+                                   os.path.getsize(path) / 1048576.0)
+
+    rnd = random.Random(1)
+    lookups = [rnd.choice(entries) for _ in xrange(args.lookups)]
+    with open(path, 'rb') as fh:
+        stream = WarcRecord.open_archive(file_handle=fh, gzip='record')
+        old = run(seek_and_read, fh, lookups)
+        new = run(read_at(stream), fh, lookups)
+    print "seek + read_records  %10.0f lookups/s" % old
+    print "read_record_at       %10.0f lookups/s" % new
+    print "speedup              %10.2fx" % (new / old)
+
+if __name__ == '__main__':
+    main()
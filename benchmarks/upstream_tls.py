@@ -0,0 +1,98 @@
+# Copyright (c) David Bern
+
+
+"""
+Times upstream TLS handshakes against a local HTTPS stand-in, with a fresh
+ClientContextFactory per connection and with the per-origin
+ClientContextCache that reuses sessions.
+
+Usage:
+    python benchmarks/upstream_tls.py [--connections 200]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.internet import reactor, protocol, ssl, defer
+
+from certauth import CertificateAuthority
+from tlsclient import ClientContextCache, ECDHE_CIPHERS
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+class Greeter(protocol.Protocol):
+    """ Sends one byte once the handshake allows application data """
+    def connectionMade(self):
+        self.transport.write('x')
+
+class TimedClient(protocol.Protocol):
+    def dataReceived(self, data):
+        self.factory.done.callback(time.time() - self.factory.started)
+        self.transport.loseConnection()
+
+class TimedClientFactory(protocol.ClientFactory):
+    protocol = TimedClient
+
+    def __init__(self):
+        self.done = defer.Deferred()
+        self.started = time.time()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.done.errback(reason)
+
+@defer.inlineCallbacks
+def run(port, connections, makeContextFactory):
+    times = []
+    for _ in xrange(connections):
+        factory = TimedClientFactory()
+        reactor.connectSSL('localhost', port, factory, makeContextFactory())
+        elapsed = yield factory.done
+        times.append(elapsed * 1000)
+    defer.returnValue(sorted(times))
+
+def report(name, times, stats=None):
+    line = "%-14s mean %6.2f ms  p50 %6.2f ms  p99 %6.2f ms" % (name,
+            sum(times) / len(times), times[len(times) // 2],
+            times[min(len(times) - 1, int(len(times) * 0.99))])
+    if stats is not None:
+        line += "  full %d resumed %d" % (stats.fullHandshakes,
+                                          stats.resumedHandshakes)
+    print line
+
+@defer.inlineCallbacks
+def main(args):
+    ca = CertificateAuthority(os.path.join(ROOT, 'ca.key'),
+                              os.path.join(ROOT, 'ca.crt'))
+    serverContext = yield ca.getContextFactory('localhost')
+    serverFactory = protocol.ServerFactory()
+    serverFactory.protocol = Greeter
+    port = reactor.listenSSL(0, serverFactory, serverContext,
+                             interface='127.0.0.1').getHost().port
+
+    times = yield run(port, args.connections, ssl.ClientContextFactory)
+    report('fresh', times)
+    cache = ClientContextCache()
+    times = yield run(port, args.connections,
+                      lambda: cache.getContextFactory('localhost', port))
+    report('cached', times, cache)
+    cache = ClientContextCache(cipherList=ECDHE_CIPHERS)
+    times = yield run(port, args.connections,
+                      lambda: cache.getContextFactory('localhost', port))
+    report('cached-ecdhe', times, cache)
+
+def start(args):
+    """ Runs main, and stops the reactor however it ends """
+    d = main(args)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upstream TLS handshakes')
+    parser.add_argument('--connections', type=int, default=200)
+    args = parser.parse_args()
+    reactor.callWhenRunning(start, args)
+    reactor.run()
@@ -0,0 +1,125 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    import cdxj
+
+    cdxj.surt('http://www.Example.com/a?b=2&a=1')
+    # 'com,example)/a?a=1&b=2'
+
+    # record as written at offset with length bytes in filename
+    line = cdxj.cdxj_line(record, 'out.warc.gz', offset, length)
+    if line is not None:
+        index.write(line)
+
+    # Sorts an index of any size, holding at most 64 MB of it in memory
+    cdxj.sort_file('out.warc.gz.cdxj')
+"""
+
+import heapq
+import json
+import os
+import re
+import tempfile
+import urlparse
+from collections import OrderedDict
+
+import warcrecords
+from hanzo.warctools import WarcRecord
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+INDEXED_TYPES = (WarcRecord.RESPONSE, WarcRecord.REVISIT, WarcRecord.RESOURCE)
+# Bytes of index lines sorted in memory at a time by sort_file
+SORT_CHUNK_SIZE = 64 * 1024 * 1024
+
+ip_rx = re.compile(r'^(\d{1,3}\.){3}\d{1,3}$|^\[')
+www_rx = re.compile(r'^www\d*\.')
+
+def surt(url):
+    """
+    Sort-friendly URI Reordering Transform: the canonical key CDX indexes
+    are sorted on. The scheme, a leading www, default ports and fragments
+    are dropped, the host labels reversed and the query arguments sorted
+    """
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url.strip())
+    host = netloc.rsplit('@', 1)[-1].lower()
+    port = ''
+    if ':' in host and not host.endswith(']'):
+        host, port = host.rsplit(':', 1)
+    if port == DEFAULT_PORTS.get(scheme.lower()):
+        port = ''
+    host = host.strip('.')
+    if not ip_rx.match(host):
+        host = ','.join(reversed(www_rx.sub('', host).split('.')))
+    key = host + (':' + port if port else '') + ')' + (path or '/')
+    if query:
+        key += '?' + '&'.join(sorted(query.split('&')))
+    return key.lower()
+
+def warc_timestamp(date):
+    """ 2014-01-30T12:00:01Z becomes 20140130120001 """
+    return re.sub(r'\D', '', date or '')[:14]
+
+def cdxj_line(record, filename, offset, length):
+    """
+    Returns the CDXJ line for a record written at offset, taking length
+    bytes of filename, or None for records that are not indexed
+    """
+    if record.type not in INDEXED_TYPES or not record.url:
+        return None
+    content_type, block = record.content
+    status = None
+    if content_type and content_type.startswith('application/http'):
+        status, mime = warcrecords.http_status_and_type(
+                                            warcrecords.http_head(block))
+    else:
+        mime = content_type
+    if record.type == WarcRecord.REVISIT:
+        mime = 'warc/revisit'
+    digest = record.get_header(WarcRecord.PAYLOAD_DIGEST) or \
+             record.get_header(WarcRecord.BLOCK_DIGEST)
+    # Same field order as pywb
+    fields = OrderedDict([('url', record.url)])
+    if mime:
+        fields['mime'] = mime
+    if status:
+        fields['status'] = status
+    if digest:
+        fields['digest'] = digest.split(':', 1)[-1]
+    fields['length'] = str(length)
+    fields['offset'] = str(offset)
+    fields['filename'] = filename
+    return '%s %s %s\n' % (surt(record.url), warc_timestamp(record.date),
+                           json.dumps(fields))
+
+def _sorted_run(lines, tmpdir):
+    """ Writes lines sorted to a temporary file, rewound for reading """
+    lines.sort()
+    run = tempfile.TemporaryFile(prefix='warcmitm-cdxj-', dir=tmpdir)
+    run.writelines(lines)
+    run.seek(0)
+    return run
+
+def sort_file(path, chunk_size=SORT_CHUNK_SIZE):
+    """
+    Sorts the lines of path in place, byte-wise like LC_ALL=C sort. Runs
+    of about chunk_size bytes are sorted in memory and written to
+    temporary files next to path, which are then merged, so memory use
+    does not grow with the size of the index
+    """
+    tmpdir = os.path.dirname(os.path.abspath(path))
+    runs = []
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                lines = f.readlines(chunk_size)
+                if not lines:
+                    break
+                runs.append(_sorted_run(lines, tmpdir))
+        with open(path + '.tmp', 'wb') as out:
+            out.writelines(heapq.merge(*runs))
+    finally:
+        for run in runs:
+            run.close()
+    os.rename(path + '.tmp', path)
@@ -0,0 +1,187 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    from certauth import CertificateAuthority
+
+    ca = CertificateAuthority('ca.key', 'ca.crt')
+    d = ca.getContextFactory('example.com')
+    d.addCallback(lambda ctxFactory: transport.startTLS(ctxFactory))
+"""
+
+import re
+import random
+import time
+import weakref
+from collections import OrderedDict
+
+from OpenSSL import crypto, SSL
+from twisted.internet import defer, threads
+
+try:
+    # pyOpenSSL has no public way to ask if a handshake was resumed
+    from OpenSSL._util import lib as _lib
+    def session_reused(connection):
+        return bool(_lib.SSL_session_reused(connection._ssl))
+except ImportError:
+    session_reused = None
+
+ip_rx = re.compile(r'^(\d{1,3}\.){3}\d{1,3}$|:')
+
+"""
+Holds a ready made SSL.Context. Has the getContext() method startTLS expects
+
+"""
+class HostContextFactory(object):
+    def __init__(self, host, context):
+        self.host = host
+        self._context = context
+
+    def getContext(self):
+        return self._context
+
+"""
+Mints a leaf certificate for every host the browser connects to, signed by
+the CA in keyFile/certFile. The CA is read when the first certificate is
+asked for, so a proxy that only sees plain HTTP does not need it. Minted
+contexts are kept in an LRU cache of cacheSize hosts, so repeat tunnels only
+cost a dictionary lookup. Key generation and signing run in the reactor's
+thread pool, and concurrent requests for the same host share one mint.
+Each context keeps a server-side session cache and issues session tickets,
+so the browser's parallel tunnels to a host can resume instead of doing a
+full handshake. fullHandshakes and resumedHandshakes count both kinds, and
+handshakeTimes maps each SSL.Connection to the time its handshake finished.
+
+"""
+class CertificateAuthority(object):
+    def __init__(self, keyFile='ca.key', certFile='ca.crt', cacheSize=256,
+                 keyBits=2048, digest='sha256', validDays=365,
+                 sessionTimeout=3600):
+        self.keyFile = keyFile
+        self.certFile = certFile
+        self.caKey = self.caCert = None
+        self.cacheSize = cacheSize
+        self.keyBits = keyBits
+        self.digest = digest
+        self.validDays = validDays
+        self.sessionTimeout = sessionTimeout
+        self.fullHandshakes = 0
+        self.resumedHandshakes = 0
+        self.handshakeTimes = weakref.WeakKeyDictionary()
+        self._cache = OrderedDict()
+        self._minting = {}
+        self._serial = random.SystemRandom()
+
+    def load(self):
+        """ Reads the CA key and certificate if they were not read yet """
+        if self.caCert is not None:
+            return
+        with open(self.keyFile, 'rb') as f:
+            caKey = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+        with open(self.certFile, 'rb') as f:
+            self.caCert = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                                  f.read())
+        self.caKey = caKey
+
+    def getCachedContextFactory(self, host):
+        """ Returns the HostContextFactory for host if it was minted already """
+        ctxFactory = self._cache.pop(host, None)
+        if ctxFactory is not None:
+            self._cache[host] = ctxFactory
+        return ctxFactory
+
+    def getContextFactory(self, host):
+        """ Returns a Deferred that fires with a HostContextFactory for host """
+        host = host.lower()
+        ctxFactory = self.getCachedContextFactory(host)
+        if ctxFactory is not None:
+            return defer.succeed(ctxFactory)
+        d = defer.Deferred()
+        if host in self._minting:
+            self._minting[host].append(d)
+        else:
+            try:
+                self.load()
+            except (IOError, crypto.Error):
+                return defer.fail()
+            self._minting[host] = [d]
+            minted = threads.deferToThread(self.mint, host)
+            minted.addBoth(self._minted, host)
+        return d
+
+    def _minted(self, result, host):
+        waiting = self._minting.pop(host)
+        if isinstance(result, HostContextFactory):
+            self._cache[host] = result
+            while len(self._cache) > self.cacheSize:
+                self._cache.popitem(last=False)
+        for d in waiting:
+            if isinstance(result, HostContextFactory):
+                d.callback(result)
+            else:
+                d.errback(result)
+
+    def mint(self, host):
+        """ Creates a key, certificate and context for host. Blocks """
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, self.keyBits)
+
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.set_serial_number(self._serial.getrandbits(63))
+        # Back date a day to allow for clock skew
+        cert.gmtime_adj_notBefore(-24 * 60 * 60)
+        cert.gmtime_adj_notAfter(self.validDays * 24 * 60 * 60)
+        cert.set_issuer(self.caCert.get_subject())
+        cert.get_subject().CN = host[:64]
+        san = ('IP:%s' if ip_rx.match(host) else 'DNS:%s') % host
+        cert.add_extensions([
+            crypto.X509Extension('basicConstraints', False, 'CA:FALSE'),
+            crypto.X509Extension('subjectAltName', False, san),
+        ])
+        cert.set_pubkey(key)
+        cert.sign(self.caKey, self.digest)
+
+        context = SSL.Context(SSL.SSLv23_METHOD)
+        context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+        context.use_privatekey(key)
+        context.use_certificate(cert)
+        context.add_extra_chain_cert(self.caCert)
+        context.set_tlsext_servername_callback(self._serverName)
+        # Session IDs are only looked up within the same id context.
+        # Tickets are on by default, with keys private to this context
+        context.set_session_id(host[:32])
+        context.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+        context.set_timeout(self.sessionTimeout)
+        context.set_info_callback(self._handshakeInfo)
+        return HostContextFactory(host, context)
+
+    def _handshakeInfo(self, connection, where, ret):
+        if not where & SSL.SSL_CB_HANDSHAKE_DONE:
+            return
+        # TLS 1.3 can report more than one HANDSHAKE_DONE per connection
+        if connection in self.handshakeTimes:
+            return
+        self.handshakeTimes[connection] = time.time()
+        if session_reused is not None and session_reused(connection):
+            self.resumedHandshakes += 1
+        else:
+            self.fullHandshakes += 1
+
+    def _serverName(self, connection):
+        """
+        The context is picked from the CONNECT host before the handshake.
+        If the browser sends a different SNI name, switch to its context
+        when it is cached, and mint one for next time when it is not
+        """
+        name = connection.get_servername()
+        if not name:
+            return
+        name = name.lower()
+        ctxFactory = self.getCachedContextFactory(name)
+        if ctxFactory is not None:
+            if ctxFactory.getContext() is not connection.get_context():
+                connection.set_context(ctxFactory.getContext())
+        elif name not in self._minting:
+            self.getContextFactory(name).addErrback(lambda _: None)
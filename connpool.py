@@ -0,0 +1,118 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    from connpool import UpstreamConnectionPool
+
+    pool = UpstreamConnectionPool(maxIdlePerHost=4)
+    key = ('https', 'example.com', 443)
+
+    # None if no healthy idle connection is available
+    clientProtocol = pool.getConnection(key)
+
+    # When the browser side goes away
+    pool.putConnection(key, clientProtocol)
+"""
+
+import time
+
+from twisted.internet import reactor
+
+"""
+Keeps idle keep-alive connections to upstream servers so later browser
+connections to the same (scheme, host, port) skip TCP and TLS setup.
+
+Pooled protocols must provide isIdle() and have pool and poolKey attributes,
+which are set while the protocol sits in the pool so that its connectionLost
+can call removeConnection.
+
+"""
+class UpstreamConnectionPool(object):
+    def __init__(self, maxIdle=64, maxIdlePerHost=4, idleTimeout=60,
+                 reactor=reactor):
+        self.maxIdle = maxIdle
+        self.maxIdlePerHost = maxIdlePerHost
+        self.idleTimeout = idleTimeout
+        self._reactor = reactor
+        # key -> list of (protocol, time released, timeout call), oldest first
+        self._idle = {}
+        self._count = 0
+
+    def getConnection(self, key):
+        """
+        Returns the most recently released healthy connection for key, or
+        None. Connections that fail the health check are closed
+        """
+        connections = self._idle.get(key)
+        while connections:
+            protocol, _, timeout = connections.pop()
+            self._count -= 1
+            timeout.cancel()
+            protocol.pool = protocol.poolKey = None
+            if self._healthy(protocol):
+                if not connections:
+                    del self._idle[key]
+                return protocol
+            protocol.transport.loseConnection()
+        self._idle.pop(key, None)
+        return None
+
+    def putConnection(self, key, protocol):
+        """
+        Keeps protocol for reuse, or closes it if it is not idle or the
+        pool is full
+        """
+        if not self._healthy(protocol) or self.maxIdlePerHost <= 0:
+            protocol.transport.loseConnection()
+            return
+        connections = self._idle.get(key, [])
+        if len(connections) >= self.maxIdlePerHost:
+            self._drop(key, connections[0][0])
+        elif self._count >= self.maxIdle:
+            self._dropOldest()
+        # Dropping the last connection for a key removes its list
+        connections = self._idle.setdefault(key, [])
+        timeout = self._reactor.callLater(self.idleTimeout, self._drop,
+                                          key, protocol)
+        protocol.pool, protocol.poolKey = self, key
+        connections.append((protocol, time.time(), timeout))
+        self._count += 1
+
+    def removeConnection(self, key, protocol):
+        """ Forgets about an idle connection, called when it is lost """
+        connections = self._idle.get(key, [])
+        for n, (p, _, timeout) in enumerate(connections):
+            if p is protocol:
+                del connections[n]
+                self._count -= 1
+                if timeout.active():
+                    timeout.cancel()
+                break
+        if not connections:
+            self._idle.pop(key, None)
+        protocol.pool = protocol.poolKey = None
+
+    def closeCachedConnections(self):
+        for key, connections in self._idle.items():
+            for protocol, _, _ in list(connections):
+                self._drop(key, protocol)
+
+    def _drop(self, key, protocol):
+        self.removeConnection(key, protocol)
+        protocol.transport.loseConnection()
+
+    def _dropOldest(self):
+        oldest = None
+        for key, connections in self._idle.iteritems():
+            if connections and (oldest is None or
+                                connections[0][1] < oldest[2]):
+                oldest = (key, connections[0][0], connections[0][1])
+        if oldest is not None:
+            self._drop(oldest[0], oldest[1])
+
+    @staticmethod
+    def _healthy(protocol):
+        transport = protocol.transport
+        return transport is not None and transport.connected and \
+               not transport.disconnecting and protocol.isIdle()
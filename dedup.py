@@ -0,0 +1,239 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    from dedup import DigestIndex
+
+    index = DigestIndex('dedup.idx')
+    original = index.get('sha1:2Z7G...')
+    if original is None:
+        index.put('sha1:2Z7G...', record_id, url, date)
+    else:
+        record_id, url, date = original
+    index.close()
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+
+MAGIC = 'WTMDIDX1'
+# Magic, slots, entries, and while the table is being grown, how many slots
+# of the old table have been moved into this one
+HEADER = struct.Struct('<8sQQQ')
+HEADER_SIZE = 64
+# sha1 of the digest string, then offset + 1 of its line in the data file
+SLOT = struct.Struct('<20sQ')
+EMPTY_KEY = '\0' * 20
+DEFAULT_SLOTS = 1 << 20
+# Slots of the old table moved into the new one by each put while growing
+GROW_STEP = 256
+
+"""
+Persistent map from payload digest to the record that first stored the
+payload: (record ID, target URI, date).
+
+Lookups are O(1). The slot file is an open-addressing hash table with
+linear probing. It is memory-mapped, so a lookup touches a page or two
+rather than reading the whole index. The slot holds a hash of the digest
+and points to a line in an append-only data file, path.data.
+
+When the table is more than maxLoad full a table of twice the size is
+started in path.tmp. New entries go into it, and each put moves the next
+GROW_STEP slots of the old table across, so no single put has to rehash
+the whole table. Lookups check both tables until the old one is empty,
+which happens long before the new one fills up. The move is resumed if
+the index is reopened part way through. For very large crawls, an
+initialSlots above the expected number of entries avoids growing at all.
+
+The data line is written before its slot, so after a crash the table
+only refers to complete lines. Only one process may have an index open.
+
+"""
+class DigestIndex(object):
+    def __init__(self, path, initialSlots=DEFAULT_SLOTS, maxLoad=0.7):
+        self.path = path
+        self.maxLoad = maxLoad
+        self.lookups = 0
+        self.hits = 0
+        self._data = open(path + '.data', 'a+b')
+        self._old = None
+        if not os.path.exists(path):
+            self._create(path, initialSlots)
+        self._open()
+
+    @staticmethod
+    def _create(path, slots):
+        # Created under another name so a crash never leaves a short table
+        with open(path + '.new', 'wb') as f:
+            f.write(HEADER.pack(MAGIC, slots, 0, 0).ljust(HEADER_SIZE, '\0'))
+            f.truncate(HEADER_SIZE + slots * SLOT.size)
+        os.rename(path + '.new', path)
+
+    @staticmethod
+    def _mapTable(path):
+        f = open(path, 'r+b')
+        m = mmap.mmap(f.fileno(), 0)
+        header = HEADER.unpack_from(m, 0)
+        if header[0] != MAGIC:
+            m.close()
+            f.close()
+            raise ValueError("%s is not a digest index" % path)
+        return f, m, header[1:]
+
+    def _open(self):
+        tmp = self.path + '.tmp'
+        if os.path.exists(tmp):
+            # Growing was interrupted, carry on where it stopped
+            oldFile, oldMap, (oldSlots, _, _) = self._mapTable(self.path)
+            self._old = (oldFile, oldMap, oldSlots)
+            self._file, self._map, header = self._mapTable(tmp)
+            self.slots, self.count, self._moved = header
+        else:
+            self._file, self._map, header = self._mapTable(self.path)
+            self.slots, self.count, _ = header
+            self._moved = 0
+
+    def _closeMap(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+        if self._old is not None:
+            self._old[1].close()
+            self._old[0].close()
+            self._old = None
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        return self._lookup(self._key(digest), digest)[1] is not None
+
+    @staticmethod
+    def _key(digest):
+        key = hashlib.sha1(digest).digest()
+        # An all zero key marks an empty slot
+        return key if key != EMPTY_KEY else '\0' * 19 + '\1'
+
+    def _find(self, table, slots, key, digest):
+        """
+        Returns (slot number, data line) for digest in table. The line is
+        None and the slot is the empty one it would go in if digest is not
+        in that table
+        """
+        n = struct.unpack_from('<Q', key)[0] % slots
+        while True:
+            slotKey, offset = SLOT.unpack_from(table,
+                                               HEADER_SIZE + n * SLOT.size)
+            if slotKey == EMPTY_KEY:
+                return n, None
+            if slotKey == key:
+                line = self._readLine(offset - 1)
+                if line.split(' ', 1)[0] == digest:
+                    return n, line
+            n = (n + 1) % slots
+
+    def _lookup(self, key, digest):
+        """ Like _find, checking the old table too while growing """
+        n, line = self._find(self._map, self.slots, key, digest)
+        if line is None and self._old is not None:
+            line = self._find(self._old[1], self._old[2], key, digest)[1]
+        return n, line
+
+    def _readLine(self, offset):
+        self._data.seek(offset)
+        return self._data.readline().rstrip('\n')
+
+    def get(self, digest):
+        """ Returns (record ID, URI, date) for digest, or None """
+        self.lookups += 1
+        line = self._lookup(self._key(digest), digest)[1]
+        if line is None:
+            return None
+        self.hits += 1
+        _, recordId, date, uri = line.split(' ', 3)
+        return recordId, uri, date
+
+    def put(self, digest, recordId, uri, date):
+        """
+        Records where the payload with digest was stored. Returns False,
+        leaving the index alone, if digest is already there
+        """
+        key = self._key(digest)
+        n, line = self._lookup(key, digest)
+        if line is not None:
+            return False
+        if self._old is None and self.count + 1 > self.slots * self.maxLoad:
+            self._startGrowing()
+            n = self._find(self._map, self.slots, key, digest)[0]
+        self._data.seek(0, os.SEEK_END)
+        offset = self._data.tell()
+        self._data.write('%s %s %s %s\n' % (digest, recordId, date, uri))
+        self._data.flush()
+        SLOT.pack_into(self._map, HEADER_SIZE + n * SLOT.size, key,
+                       offset + 1)
+        self.count += 1
+        if self._old is not None:
+            self._moveSlots(GROW_STEP)
+        self._writeHeader()
+        return True
+
+    def _writeHeader(self):
+        HEADER.pack_into(self._map, 0, MAGIC, self.slots, self.count,
+                         self._moved)
+
+    def _startGrowing(self):
+        """ Starts a table with twice the slots in path.tmp """
+        tmp = self.path + '.tmp'
+        self._create(tmp, self.slots * 2)
+        self._old = (self._file, self._map, self.slots)
+        self._file, self._map, (self.slots, _, _) = self._mapTable(tmp)
+        self._moved = 0
+        self._writeHeader()
+
+    def _moveSlots(self, count):
+        """ Copies the next count slots of the old table into the new one """
+        oldFile, old, oldSlots = self._old
+        slots = self.slots
+        end = min(self._moved + count, oldSlots)
+        for n in xrange(self._moved, end):
+            start = HEADER_SIZE + n * SLOT.size
+            slot = old[start:start + SLOT.size]
+            if slot[:20] == EMPTY_KEY:
+                continue
+            m = struct.unpack_from('<Q', slot)[0] % slots
+            while True:
+                position = HEADER_SIZE + m * SLOT.size
+                current = self._map[position:position + SLOT.size]
+                if current[:20] == EMPTY_KEY:
+                    self._map[position:position + SLOT.size] = slot
+                    break
+                if current == slot:
+                    # Moved before the index was last closed
+                    break
+                m = (m + 1) % slots
+        self._moved = end
+        if end == oldSlots:
+            self._finishGrowing()
+
+    def _finishGrowing(self):
+        oldFile, old, _ = self._old
+        self._old = None
+        # No flush: writing back the whole table at once would stall the
+        # caller, and the pages reach the file like those of any put
+        old.close()
+        oldFile.close()
+        os.rename(self.path + '.tmp', self.path)
+        self._moved = 0
+
+    def sync(self):
+        self._data.flush()
+        self._map.flush()
+
+    def close(self):
+        if self._map is not None:
+            self._closeMap()
+            self._map = None
+            self._data.close()
@@ -0,0 +1,77 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    from flowcontrol import SharedProducer
+
+    upstream = SharedProducer(upstreamTransport)
+
+    # The browser's transport pauses upstream reads while its write buffer
+    # is over its bufferSize, and the writer pauses them while its queue
+    # is full. Reads resume once neither wants them paused
+    browserShare = upstream.share()
+    browserTransport.registerProducer(browserShare, True)
+    writer.registerProducer(upstream.share())
+
+    # Before giving the browser transport another producer
+    browserTransport.unregisterProducer()
+    browserShare.stopProducing()
+"""
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+"""
+Lets several consumers pause one IPushProducer, usually a transport. Each
+consumer is given its own share(), and the producer stays paused while any
+share is paused, so one consumer resuming does not undo another's pause.
+
+"""
+class SharedProducer(object):
+    def __init__(self, producer):
+        self.producer = producer
+        self.pauses = 0
+
+    @property
+    def paused(self):
+        return self.pauses > 0
+
+    def share(self):
+        return _ProducerShare(self)
+
+    def _pause(self):
+        self.pauses += 1
+        if self.pauses == 1:
+            self.producer.pauseProducing()
+
+    def _resume(self):
+        self.pauses -= 1
+        if self.pauses == 0:
+            self.producer.resumeProducing()
+
+"""
+One consumer's view of a SharedProducer. Pausing or resuming it twice has
+no further effect. stopProducing() only drops its pause: the consumer that
+went away is not the only one reading from the producer.
+
+"""
+@implementer(IPushProducer)
+class _ProducerShare(object):
+    paused = False
+
+    def __init__(self, shared):
+        self._shared = shared
+
+    def pauseProducing(self):
+        if not self.paused:
+            self.paused = True
+            self._shared._pause()
+
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self._shared._resume()
+
+    def stopProducing(self):
+        self.resumeProducing()
@@ -14,7 +14,20 @@ class MixedParser(ArchiveParser):
         self.arc = ArcParser()
         self.warc = WarcParser()
 
+    # lazy content is only supported for warc records
+    @property
+    def lazy(self):
+        return self.warc.lazy
+
+    @lazy.setter
+    def lazy(self, lazy):
+        self.warc.lazy = lazy
+
+    def release_content(self):
+        self.warc.release_content()
+
     def parse(self, stream, offset=None):
+        self.release_content()
         line = stream.readline()
         while line:
             if line.startswith('WARC'):
@@ -1,7 +1,9 @@
 """a skeleton class for archive records"""
 
-from gzip import GzipFile
 import re
+import struct
+import time
+import zlib
 
 from hanzo.warctools.stream import open_record_stream
 
@@ -19,11 +21,205 @@ def add_headers(**kwargs):
     return _add_headers
 
 
+GZIP_CHUNK_SIZE = 1024 * 1024
+
+
+class GzipMemberWriter(object):
+    """A write-only file like class that writes everything written to it
+    as a single gzip member. Small writes are gathered into one buffer so
+    zlib is called with large contiguous chunks. flush() is a no-op, the
+    member is only complete after close().
+
+    compressor is called for a zlib compressobj when the first chunk is
+    ready. With level, a member that never fills a chunk is deflated by
+    one zlib.compress call at close() instead. Python 2's zlib module
+    holds one global lock during every compressobj call, while
+    zlib.compress runs without it, so only members of up to chunk_size
+    bytes compress in parallel on several threads"""
+
+    def __init__(self, fh, compressor, xfl, chunk_size=GZIP_CHUNK_SIZE,
+                 level=None):
+        self.fh = fh
+        self.compressor = compressor
+        self.level = level
+        self.z = None
+        self.chunk_size = chunk_size
+        self.crc = 0
+        self.size = 0
+        self.pending = bytearray()
+        # magic, deflate, no flags, mtime, extra flags, unknown os
+        fh.write(struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0,
+                             int(time.time()) & 0xffffffff, xfl, 255))
+
+    def write(self, data):
+        if len(data) >= self.chunk_size:
+            self._drain()
+            self._compress(data)
+        else:
+            self.pending += data
+            if len(self.pending) >= self.chunk_size:
+                self._drain()
+
+    def _drain(self):
+        if self.pending:
+            self._compress(buffer(self.pending))
+            del self.pending[:]
+
+    def _compress(self, data):
+        if self.z is None:
+            self.z = self.compressor()
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        out = self.z.compress(data)
+        if out:
+            self.fh.write(out)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.z is None and self.level is not None:
+            data = buffer(self.pending)
+            self.crc = zlib.crc32(data)
+            self.size = len(data)
+            out = zlib.compress(data, self.level)
+            # Without the zlib header and adler32 trailer it is the same
+            # raw deflate stream the compressobj would have made
+            self.fh.write(buffer(out, 2, len(out) - 6))
+        else:
+            self._drain()
+            if self.z is None:
+                self.z = self.compressor()
+            self.fh.write(self.z.flush())
+        self.fh.write(struct.pack('<LL', self.crc & 0xffffffff,
+                                  self.size & 0xffffffff))
+        self.z = self.compressor = self.pending = None
+
+
+class GzipRecordEncoder(object):
+    """Writes records as individual gzip members using zlib directly.
+    The compressor is configured once and copied for every member, so the
+    level and strategy are set by whoever creates the encoder. Members of
+    up to chunk_size bytes are made with zlib.compress when the strategy
+    and mem_level are the defaults it uses"""
+
+    def __init__(self, level=9, strategy=zlib.Z_DEFAULT_STRATEGY,
+                 mem_level=zlib.DEF_MEM_LEVEL, chunk_size=GZIP_CHUNK_SIZE):
+        self.level = level
+        self.strategy = strategy
+        self.chunk_size = chunk_size
+        self._template = zlib.compressobj(level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS, mem_level, strategy)
+        defaults = (strategy == zlib.Z_DEFAULT_STRATEGY and
+                    mem_level == zlib.DEF_MEM_LEVEL)
+        self._oneshot_level = level if defaults else None
+        # extra flags field: 2 is max compression, 4 is fastest
+        self._xfl = 2 if level == 9 else 4 if level == 1 else 0
+
+    def open_member(self, fh):
+        """Returns a GzipMemberWriter for one record, close() it when done"""
+        return GzipMemberWriter(fh, self._template.copy, self._xfl,
+                                self.chunk_size, self._oneshot_level)
+
+    def encode(self, record, fh, newline='\x0D\x0A'):
+        out = self.open_member(fh)
+        record._write_to(out, newline)
+        out.close()
+
+default_gzip_encoder = GzipRecordEncoder()
+
+
 class ArchiveParser(object):
     """ methods parse, and trim """
     pass
 
 
+LAZY_CHUNK_SIZE = 1024 * 1024
+
+class LazyContent(object):
+    """The block of a record parsed in lazy mode, still sitting in the
+    stream it was parsed from. Nothing is copied out until it is used:
+    read() streams it, getvalue(), str() or slicing load all of it.
+    Like any str block it has a length and can be written or digested,
+    which also loads it. It is only readable until the parser moves on
+    to the next record, which skips whatever was not read"""
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._length = length
+        self._pos = 0
+        self._value = None
+        self._released = False
+
+    def __len__(self):
+        return self._length
+
+    def __nonzero__(self):
+        return self._length > 0
+
+    def _check(self):
+        if self._released:
+            raise StandardError('record content is no longer available, '
+                                'the parser has moved past it')
+
+    def read(self, size=-1):
+        """Reads the next size bytes of the block, or the rest of it"""
+        remaining = self._length - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if self._value is not None:
+            data = self._value[self._pos:self._pos + size]
+        else:
+            self._check()
+            data = self._stream.read(size) if size else ''
+        self._pos += len(data)
+        return data
+
+    def getvalue(self):
+        """Returns the whole block as a str, reading it on first use"""
+        if self._value is None:
+            self._check()
+            if self._pos:
+                raise StandardError('record content was partly read')
+            self._value = self._stream.read(self._length)
+            self._pos = 0
+        return self._value
+
+    def iterchunks(self, size=LAZY_CHUNK_SIZE):
+        value = self.getvalue()
+        for start in xrange(0, len(value), size):
+            yield buffer(value, start, size)
+
+    def __str__(self):
+        return self.getvalue()
+
+    def __getitem__(self, key):
+        return self.getvalue()[key]
+
+    def release(self):
+        """Skips what was not read. Called by the parser before it reads
+        the next record from the stream"""
+        if self._value is not None or self._released:
+            return
+        self._released = True
+        remaining = self._length - self._pos
+        if not remaining:
+            return
+        if hasattr(self._stream, 'skip'):
+            self._stream.skip(remaining)
+            return
+        try:
+            self._stream.seek(remaining, 1)
+            return
+        except (AttributeError, IOError):
+            pass
+        while remaining > 0:
+            data = self._stream.read(min(remaining, LAZY_CHUNK_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+
+
 @add_headers(DATE='Date',
              CONTENT_TYPE='Type',
              CONTENT_LENGTH='Length',
@@ -99,13 +295,15 @@ class ArchiveRecord(object):
             for e in self.errors:
                 print '\t', e
 
-    def write_to(self, out, newline='\x0D\x0A', gzip=False):
+    def write_to(self, out, newline='\x0D\x0A', gzip=False, encoder=None):
+        """Writes the record to out. With gzip the record is written as its
+        own gzip member using encoder, a GzipRecordEncoder"""
         if gzip:
-            out = GzipFile(fileobj=out)
-        self._write_to(out, newline)
-        if gzip:
-            out.flush()
-            out.close()
+            if encoder is None:
+                encoder = default_gzip_encoder
+            encoder.encode(self, out, newline)
+        else:
+            self._write_to(out, newline)
 
     def _write_to(self, out, newline):
         raise AssertionError('this is bad')
@@ -113,11 +311,16 @@ class ArchiveRecord(object):
     ### class methods for parsing
     @classmethod
     def open_archive(cls, filename=None, file_handle=None,
-                     mode="rb+", gzip="auto"):
-        """Generically open an archive - magic autodetect"""
+                     mode="rb+", gzip="auto", lazy=False, mmap=False):
+        """Generically open an archive - magic autodetect. With lazy,
+        warc record content is a LazyContent that is only read when used,
+        and is skipped by scans that look at headers alone. With mmap,
+        an uncompressed archive is memory-mapped and warc record content
+        is a buffer into the map"""
         if cls is ArchiveRecord:
             cls = None # means guess
-        return open_record_stream(cls, filename, file_handle, mode, gzip)
+        return open_record_stream(cls, filename, file_handle, mode, gzip,
+                                  lazy, mmap)
 
     @classmethod
     def make_parser(self):
@@ -1,16 +1,21 @@
 """Read records from normal file and compressed file"""
 
+import os
 import zlib
 import gzip
-import re
+from cStringIO import StringIO
+from mmap import mmap as _mmap, ACCESS_READ, ALLOCATIONGRANULARITY
 
 from hanzo.warctools.archive_detect import is_gzip_file, guess_record_type
 
 def open_record_stream(record_class=None, filename=None, file_handle=None,
-                       mode="rb+", gzip="auto"):
+                       mode="rb+", gzip="auto", lazy=False, mmap=False):
     """Can take a filename or a file_handle. Normally called
     indirectly from A record class i.e WarcRecord.open_archive. If the
-    first parameter is None, will try to guess"""
+    first parameter is None, will try to guess. With lazy, warc record
+    content is only read from the file when it is used. With mmap, an
+    uncompressed file is memory-mapped and warc record content is a
+    buffer into the map rather than a copy"""
 
     if file_handle is None:
         file_handle = open(filename, mode=mode)
@@ -25,6 +30,8 @@ def open_record_stream(record_class=None, filename=None, file_handle=None,
         raise StandardError('Failed to guess compression')
 
     record_parser = record_class.make_parser()
+    if lazy:
+        record_parser.lazy = True
 
     if gzip == 'auto':
         if is_gzip_file(file_handle):
@@ -39,9 +46,26 @@ def open_record_stream(record_class=None, filename=None, file_handle=None,
         return GzipRecordStream(file_handle, record_parser)
     elif gzip == 'file':
         return GzipFileStream(file_handle, record_parser)
+    elif mmap and os.fstat(file_handle.fileno()).st_size > 0:
+        return MmapRecordStream(file_handle, record_parser)
     else:
         return RecordStream(file_handle, record_parser)
-        
+
+def _pread(fh, length, offset):
+    """Reads up to length bytes at offset without moving the file
+    position. Uses a single pread where the os module has one, otherwise
+    a seek and a read, then seeks back"""
+    if hasattr(os, 'pread'):
+        return os.pread(fh.fileno(), length, offset)
+    position = fh.tell()
+    try:
+        fh.seek(offset)
+        return fh.read(length)
+    finally:
+        fh.seek(position)
+
+READ_AT_CHUNK_SIZE = 64 * 1024
+
 
 class RecordStream(object):
     """A readable/writable stream of Archive Records. Can be iterated over
@@ -83,10 +107,40 @@ class RecordStream(object):
             
     def _read_record(self, offsets):
         """overridden by sub-classes to read individual records"""
+        # a lazy parser may have left the stream inside the last record
+        release = getattr(self.record_parser, 'release_content', None)
+        if release is not None:
+            release()
         offset = self.fh.tell() if offsets else None
         record, errors, offset = self.record_parser.parse(self.fh, offset)
         return offset, record, errors
 
+    def read_record_at(self, offset, length=None):
+        """Returns the one record starting at offset. length is how many
+        bytes of the file the record takes, as found in a CDX index.
+        When it is given the record is read in one go and parsed from
+        memory. The file position is put back afterwards, so a
+        read_records loop carries on where it was"""
+        if length is None:
+            position = self.fh.tell()
+            try:
+                self.fh.seek(offset)
+                return self._parse_at(self.fh, offset)
+            finally:
+                self.fh.seek(position)
+        return self._parse_at(StringIO(_pread(self.fh, length, offset)),
+                              offset)
+
+    def _parse_at(self, stream, offset):
+        # A new parser, so nothing carries over from the previous record
+        parser = self.record_parser.__class__()
+        record, errors, _offset = parser.parse(stream, offset)
+        if not record:
+            error_str = ",".join(str(error) for error in errors)
+            raise StandardError("No record at offset %d: %s" %
+                                (offset, error_str))
+        return record
+
     def write(self, record):
         """Writes an archive record to the stream"""
         record.write_to(self)
@@ -122,6 +176,27 @@ class GzipRecordStream(RecordStream):
             self.record_parser.parse(self.gz, offset=None)
         errors.extend(r_errors)
         return offset, record, errors
+
+    def read_record_at(self, offset, length=None):
+        """Returns the record in the gzip member starting at offset.
+        With the member's length, as found in a CDX index, it is read
+        with one read and inflated with one zlib call. None of the
+        readline machinery is involved, and the file position is left
+        where read_records had it"""
+        z = zlib.decompressobj(16+zlib.MAX_WBITS)
+        if length is not None:
+            data = z.decompress(_pread(self.fh, length, offset))
+        else:
+            data = []
+            position = offset
+            while not z.unused_data:
+                chunk = _pread(self.fh, READ_AT_CHUNK_SIZE, position)
+                if not chunk:
+                    break
+                position += len(chunk)
+                data.append(z.decompress(chunk))
+            data = "".join(data)
+        return self._parse_at(StringIO(data), offset)
                 
 
 class GzipFileStream(RecordStream):
@@ -133,83 +208,211 @@ class GzipFileStream(RecordStream):
         # no real offsets in a gzipped file (no seperate records)
         return RecordStream._read_record(self, False)
 
+    def read_record_at(self, offset, length=None):
+        raise StandardError('records in a gzipped file have no offsets')
+
+# Size of the part of the file mapped at a time
+MMAP_WINDOW = 64 * 1024 * 1024
+
+class MmapFile(object):
+    """A read-only file like view of a file through mmap. The file is
+    mapped a window at a time, so the pages of records already passed
+    are unmapped once nothing refers to them. readline() copies out only
+    the line, read_view(n) returns the next n bytes as a buffer into the
+    map without copying them"""
+    def __init__(self, fileno, size, window=MMAP_WINDOW):
+        self.fileno = fileno
+        self.size = size
+        self.window = window
+        self.pos = 0
+        self.map = None
+        self.base = 0
+
+    def _map(self, start, length):
+        """Makes sure start to start+length is in the current map"""
+        end = min(start + length, self.size)
+        if self.map is not None and self.base <= start and \
+           end <= self.base + len(self.map):
+            return
+        base = start - start % ALLOCATIONGRANULARITY
+        length = min(max(self.window, end - base), self.size - base)
+        # the old map stays alive while buffers still point into it
+        self.map = _mmap(self.fileno, length, access=ACCESS_READ,
+                         offset=base)
+        self.base = base
+
+    def readline(self):
+        if self.pos >= self.size:
+            return ''
+        length = 64 * 1024
+        while True:
+            self._map(self.pos, length)
+            nl = self.map.find('\n', self.pos - self.base)
+            end = self.base + len(self.map)
+            if nl != -1:
+                end = self.base + nl + 1
+                break
+            if end >= self.size:
+                break
+            length = (end - self.pos) * 2
+        line = self.map[self.pos - self.base:end - self.base]
+        self.pos = end
+        return line
+
+    def read(self, size=-1):
+        return str(self.read_view(size))
+
+    def read_view(self, size=-1):
+        if size < 0 or size > self.size - self.pos:
+            size = max(0, self.size - self.pos)
+        self._map(self.pos, size)
+        view = buffer(self.map, self.pos - self.base, size)
+        self.pos += size
+        return view
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, offset)
+
+    def close(self):
+        # buffers already handed out keep their map open
+        self.map = None
+
+
+class MmapRecordStream(RecordStream):
+    """Reads an uncompressed file through mmap. Warc headers are parsed
+    line by line straight from the map and record content is a buffer
+    over the mapped pages, so scanning copies nothing but the headers.
+    Only a window of the file is mapped at a time, so memory use does not
+    grow with the file size. Content is only copied when the caller
+    converts it with str()"""
+    def __init__(self, file_handle, record_parser):
+        self.file_handle = file_handle
+        RecordStream.__init__(self, MmapFile(file_handle.fileno(),
+                                  os.fstat(file_handle.fileno()).st_size),
+                              record_parser)
+
+    def read_record_at(self, offset, length=None):
+        """Parses the record at offset in place, then puts the stream
+        position back"""
+        position = self.fh.tell()
+        try:
+            self.fh.seek(offset)
+            return self._parse_at(self.fh, offset)
+        finally:
+            self.fh.seek(position)
+
+    def close(self):
+        self.fh.close()
+        self.file_handle.close()
+
+
 ### record-gzip handler, based on zlib 
-### implements readline() access over a a single
+### implements readline() and read() access over a a single
 ### gzip-record. must be re-created to read another record
-    
 
-CHUNK_SIZE = 1024 # the size to read in, make this bigger things go faster.
-line_rx = re.compile('^(?P<line>^[^\r\n]*(?:\r\n|\r(?!\n)|\n))(?P<tail>.*)$',
-                     re.DOTALL)
+# Reads start small, so short records do not read far past their member,
+# and double up to CHUNK_SIZE while the member continues
+INITIAL_CHUNK_SIZE = 8 * 1024
+CHUNK_SIZE = 1024 * 1024
 
 class GzipRecordFile(object):
-    """A file like class providing 'readline' over catted gzip'd records"""
-    def __init__(self, fh):
+    """A file like class providing 'readline' and 'read' over catted
+    gzip'd records.
+
+    Inflated data is appended to a bytearray and handed out from a read
+    position, so nothing is copied more than once. The consumed front is
+    dropped once it is more than half of the buffer. Line ends are found
+    with find(), remembering how far a line has already been scanned, so
+    reading is linear however long the lines are."""
+    def __init__(self, fh, chunk_size=CHUNK_SIZE):
         self.fh = fh
-        self.buffer = ""
+        self.chunk_size = chunk_size
         self.z = zlib.decompressobj(16+zlib.MAX_WBITS)
         self.done = False
-
-
-    def _getline(self):
-        if self.buffer:
-            #a,nl,b
-            match = line_rx.match(self.buffer)
-            #print match
-            # print 'split:', split[0],split[1], len(split[2])
-            if match: 
-                output = match.group('line')
-
-                self.buffer = ""+match.group('tail')
-                return output
-            
-            elif self.done:
-                output = self.buffer
-                self.buffer = ""
-
-                return output
+        self._buf = bytearray()
+        self._pos = 0
+        # _buf[_pos:_scanned] holds no line end
+        self._scanned = 0
+        self._next_read = min(INITIAL_CHUNK_SIZE, chunk_size)
+
+    def _fill(self):
+        """Inflates the next chunk of the member into the buffer"""
+        if self._pos > len(self._buf) // 2:
+            del self._buf[:self._pos]
+            self._scanned -= self._pos
+            self._pos = 0
+        chunk = self.fh.read(self._next_read)
+        self._next_read = min(self._next_read * 2, self.chunk_size)
+        if chunk:
+            self._buf += self.z.decompress(chunk)
+        if self.z.unused_data:
+            self.fh.seek(-len(self.z.unused_data), 1)
+            self.done = True
+        elif not chunk:
+            self.done = True
+
+    def _take(self, end):
+        output = str(buffer(self._buf, self._pos, end - self._pos))
+        self._pos = end
+        self._scanned = end
+        return output
 
     def readline(self):
+        """Returns the next line including its \\r\\n, \\n or lone \\r,
+        or "" at the end of the member"""
+        buf = self._buf
         while True:
-            output = self._getline()
-            if output:
-                    return output
-
+            start = max(self._pos, self._scanned)
+            nl = buf.find('\n', start)
+            limit = nl if nl != -1 else len(buf)
+            cr = buf.find('\r', start, limit)
+            if cr != -1:
+                if cr + 1 < len(buf):
+                    return self._take(cr + 2 if buf[cr + 1] == 10 else cr + 1)
+                if self.done:
+                    return self._take(cr + 1)
+                # Need the next byte to tell \r\n from a lone \r
+                self._scanned = cr
+            elif nl != -1:
+                return self._take(nl + 1)
+            else:
+                self._scanned = len(buf)
             if self.done:
-                return ""
-            
-            #print 'read chunk at', self.fh.tell(), self.done
-            chunk = self.fh.read(CHUNK_SIZE)
-            out = self.z.decompress(chunk)
-            # if we hit a \r on reading a chunk boundary, read a little more
-            # in case there is a following \n 
-            while out.endswith('\r') and not self.z.unused_data:
-                    chunk = self.fh.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    tail =  self.z.decompress(chunk)
-                    if tail:
-                        out+=tail
-                        break
-
-
-            if out:
-                self.buffer += out
-
-            if self.z.unused_data:
-                #print 'unused', len(self.z.unused_data)
-                self.fh.seek(-len(self. z.unused_data), 1)
-                self.done = True
-                continue
-            if not chunk:
-                self.done = True
-                continue
+                return self._take(len(buf))
+            self._fill()
+            buf = self._buf
+
+    def read(self, size=-1):
+        """Returns up to size bytes, fewer only at the end of the member.
+        With no size, returns the rest of the member"""
+        while not self.done and \
+              (size < 0 or len(self._buf) - self._pos < size):
+            self._fill()
+        end = len(self._buf) if size < 0 else \
+              min(len(self._buf), self._pos + size)
+        return self._take(end)
+
+    def skip(self, size):
+        """Discards the next size bytes without copying them out"""
+        while size > 0:
+            available = len(self._buf) - self._pos
+            if available >= size:
+                self._pos += size
+                break
+            size -= available
+            self._pos = len(self._buf)
+            if self.done:
+                break
+            self._fill()
+        self._scanned = self._pos
 
     def close(self):
         if self.z:
             self.z.flush()
-            
-                
-    
-            
-                
@@ -3,7 +3,7 @@ record.py"""
 
 import re
 import hashlib
-from hanzo.warctools.record import ArchiveRecord, ArchiveParser
+from hanzo.warctools.record import ArchiveRecord, ArchiveParser, LazyContent
 from hanzo.warctools.archive_detect import register_record_type
 
 bad_lines = 5 # when to give up looking for the version stamp
@@ -15,10 +15,14 @@ bad_lines = 5 # when to give up looking for the version stamp
     ID='WARC-Record-ID',
     CONCURRENT_TO='WARC-Concurrent-To',
     REFERS_TO='WARC-Refers-To',
+    REFERS_TO_TARGET_URI='WARC-Refers-To-Target-URI',
+    REFERS_TO_DATE='WARC-Refers-To-Date',
+    PROFILE='WARC-Profile',
     CONTENT_LENGTH='Content-Length',
     CONTENT_TYPE='Content-Type',
     URL='WARC-Target-URI',
     BLOCK_DIGEST='WARC-Block-Digest',
+    PAYLOAD_DIGEST='WARC-Payload-Digest',
     IP_ADDRESS='WARC-IP-Address',
     FILENAME='WARC-Filename',
     WARCINFO_ID='WARC-Warcinfo-ID',
@@ -39,6 +43,10 @@ class WarcRecord(ArchiveRecord):
     METADATA = "metadata"
     CONVERSION = "conversion"
     WARCINFO = "warcinfo"
+    REVISIT = "revisit"
+
+    PROFILE_IDENTICAL_PAYLOAD_DIGEST = \
+        "http://netpreserve.org/warc/1.0/revisit/identical-payload-digest"
 
     def __init__(self, version=VERSION, headers=None, content=None,
                  errors=None):
@@ -70,14 +78,17 @@ class WarcRecord(ArchiveRecord):
                 out.write(v)
                 out.write(nl)
         content_type, content_buffer = self.content
-        content_buffer = buffer(content_buffer)
+        if content_buffer is None:
+            content_buffer = ""
+        # blocks with iterchunks() are streamed rather than held in memory
+        streamed = hasattr(content_buffer, 'iterchunks')
+        if not streamed:
+            content_buffer = buffer(content_buffer)
         if content_type:
             out.write(self.CONTENT_TYPE)
             out.write(": ")
             out.write(content_type)
             out.write(nl)
-        if content_buffer is None:
-            content_buffer = ""
 
         content_length = len(content_buffer)
         out.write(self.CONTENT_LENGTH)
@@ -85,7 +96,10 @@ class WarcRecord(ArchiveRecord):
         out.write(str(content_length))
         out.write(nl)
 
-        block_digest = self.block_digest(content_buffer)
+        # a digest computed while the block was captured is used as is
+        block_digest = self.get_header(self.BLOCK_DIGEST)
+        if block_digest is None:
+            block_digest = self.block_digest(content_buffer)
 
         out.write(self.BLOCK_DIGEST)
         out.write(": ")
@@ -94,8 +108,11 @@ class WarcRecord(ArchiveRecord):
 
         # end of header blank nl
         out.write(nl)
-        if content_buffer:
-            out.write(content_buffer[:content_length])
+        if streamed:
+            for chunk in content_buffer.iterchunks():
+                out.write(chunk)
+        elif content_buffer:
+            out.write(content_buffer)
         out.write(nl)
         out.write(nl)
         out.flush()
@@ -112,7 +129,11 @@ class WarcRecord(ArchiveRecord):
 
     def block_digest(self, content_buffer):
         block_hash = hashlib.sha256()
-        block_hash.update(content_buffer)
+        if hasattr(content_buffer, 'iterchunks'):
+            for chunk in content_buffer.iterchunks():
+                block_hash.update(chunk)
+        else:
+            block_hash.update(content_buffer)
 
         digest = "sha256:%s" % block_hash.hexdigest()
         return digest
@@ -141,8 +162,11 @@ required_headers = set((
 class WarcParser(ArchiveParser):
     KNOWN_VERSIONS = set(('1.0', '0.17', '0.18'))
 
-    def __init__(self):
+    def __init__(self, lazy=False):
         self.trailing_newlines = 0
+        # In lazy mode record content is a LazyContent left in the stream
+        self.lazy = lazy
+        self._pending = None
 
     def parse(self, stream, offset, line=None):
         """Reads a warc record from the stream, returns a tuple
@@ -150,6 +174,7 @@ class WarcParser(ArchiveParser):
         null. Any record-specific errors are contained in the record -
         errors is only used when *nothing* could be parsed"""
         # pylint: disable-msg=E1101
+        self.release_content()
         errors = []
         version = None
         # find WARC/.*
@@ -262,7 +287,27 @@ class WarcParser(ArchiveParser):
 
             # read content
             if content_length is not None:
-                if content_length > 0:
+                if content_length > 0 and hasattr(stream, 'read'):
+                    # the length is known, so the content is read (or
+                    # left for later) in one piece and the trailing
+                    # newlines are all left for the next parse
+                    if self.lazy:
+                        content = LazyContent(stream, content_length)
+                        self._pending = content
+                    elif hasattr(stream, 'read_view'):
+                        # zero copy, a buffer into an mmap
+                        content = stream.read_view(content_length)
+                        if len(content) != content_length:
+                            record.error('content length mismatch (is, claims)',
+                                         len(content), content_length)
+                    else:
+                        content = stream.read(content_length)
+                        if len(content) != content_length:
+                            record.error('content length mismatch (is, claims)',
+                                         len(content), content_length)
+                    record.content = (content_type, content)
+                    self.trailing_newlines = 2
+                elif content_length > 0:
                     content = []
                     length = 0
                     while length < content_length:
@@ -312,6 +357,13 @@ class WarcParser(ArchiveParser):
 
             return (record, (), offset)
 
+    def release_content(self):
+        """In lazy mode, skips the unread content of the last record so
+        the stream is positioned after it"""
+        if self._pending is not None:
+            self._pending.release()
+            self._pending = None
+
     def trim(self, stream):
         """read the end of the file"""
         newlines = self.trailing_newlines
@@ -0,0 +1,202 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    import metrics
+
+    registry = metrics.MetricsRegistry()
+    requests = registry.counter('proxy_requests_total', 'Requests proxied')
+    requests.inc()
+    connections = registry.gauge('proxy_connections', 'Open connections')
+    connections.inc(); connections.dec()
+    # Read from existing state each time the metrics are rendered
+    registry.gauge('writer_queue', 'Records waiting',
+                   function=lambda: writer.pending)
+    latency = registry.histogram('write_seconds', 'Time to write a record')
+    latency.observe(0.002)
+
+    # Count the bytes written to a transport
+    transport = metrics.CountingTransport(transport, sentBytes)
+
+    # Serve the Prometheus text format on http://127.0.0.1:9100/metrics
+    metrics.listenMetrics(9100, registry)
+"""
+
+import bisect
+import threading
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+# Seconds. Covers a cached write up to a large record on a slow disk
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+def _format(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+"""
+A count that only goes up. With function, the value is read from it when
+rendered instead, for counts something else already keeps.
+
+"""
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def samples(self):
+        return [(self.name, '', self.get())]
+
+"""
+A value that goes up and down.
+
+"""
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+"""
+Counts observations into cumulative buckets, with their sum and count.
+observe() takes a lock, so writer and compressor threads can call it.
+
+"""
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name=None, help=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            samples.append((self.name + '_bucket',
+                            '{le="%s"}' % _format(float(bound)), cumulative))
+        samples.append((self.name + '_sum', '', total))
+        samples.append((self.name + '_count', '', count))
+        return samples
+
+"""
+The metrics of a process, in the order they were registered. render()
+returns them in the Prometheus text exposition format.
+
+"""
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+        self._names = set()
+
+    def register(self, metric, name=None, help=None):
+        """ Adds a metric made elsewhere, such as a writer's Histogram """
+        if name is not None:
+            metric.name = name
+        if help is not None:
+            metric.help = help
+        if metric.name in self._names:
+            raise ValueError("Metric %s is already registered" % metric.name)
+        self._names.add(metric.name)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, function=None):
+        return self.register(Counter(name, help, function))
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, _format(value)))
+        return '\n'.join(lines) + '\n'
+
+"""
+Passes everything on to transport, adding the length of whatever is written
+through it to counter.
+
+"""
+class CountingTransport(object):
+    def __init__(self, transport, counter):
+        self._transport = transport
+        self._counter = counter
+
+    def write(self, data):
+        self._counter.value += len(data)
+        self._transport.write(data)
+
+    def writeSequence(self, data):
+        data = list(data)
+        self._counter.value += sum(len(d) for d in data)
+        self._transport.writeSequence(data)
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', CONTENT_TYPE)
+        return self.registry.render()
+
+def listenMetrics(port, registry, interface='127.0.0.1', reactor=reactor):
+    """
+    Serves registry at /metrics (and any other path) on port. Only local
+    clients can connect unless another interface is given
+    """
+    site = server.Site(MetricsResource(registry))
+    site.noisy = False
+    site.log = lambda request: None
+    return reactor.listenTCP(port, site, interface=interface)
@@ -4,90 +4,140 @@
 # TOFIX: Handle Request bodies properly
 
 import argparse
+import os
 
-from twisted.internet import ssl, reactor, protocol
+from twisted.internet import reactor, protocol
 from twisted.web._newclient import HTTPParser, ParseError, Request, \
     HTTPClientParser
 from twisted.web.client import _URI
 
 from twisted.web.http import _DataLoss
+
+from certauth import CertificateAuthority
+from connpool import UpstreamConnectionPool
+from flowcontrol import SharedProducer
+from tlsclient import ClientContextCache, ECDHE_CIPHERS
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
 class _RawChunkedTransferDecoder(object):
     """
     This class is modified from t.w.http._ChunkedTransferDecoder
     Rather than only returning the body chunks, this returns raw chunks
     but makes sure it stops at the end of the body.
+    If payloadCallback is set, it is also called with only the chunk data.
+
+    Each call of dataReceived is parsed in place by moving an offset through
+    it, and the raw data up to the end of the body is passed on in one
+    piece, usually the very string that was received. Chunk data is passed
+    to payloadCallback as buffer() slices of the received string, so a chunk
+    of any size is never copied. Only an incomplete line is kept between
+    calls.
     """
     state = 'CHUNK_LENGTH'
+    payloadCallback = None
 
     def __init__(self, dataCallback, finishCallback):
         self.dataCallback = dataCallback
         self.finishCallback = finishCallback
-        self._buffer = ''
-        
-    def _rawData(self, data):
-        self.dataCallback(data)
-
-    def _dataReceived_CHUNK_LENGTH(self, data):
-        if '\r\n' in data:
-            line, rest = data.split('\r\n', 1)
-            self._rawData(line+'\r\n')
-            parts = line.split(';')
-            self.length = int(parts[0], 16)
-            if self.length == 0:
-                self.state = 'TRAILER'
-            else:
-                self.state = 'BODY'
-            return rest
+        self._line = ''
+        self._payload = []
+
+    def _readLine(self, data, pos):
+        """
+        Returns the line starting at pos without its line ending, and the
+        offset after it. The line is None if data ends before the line does
+        """
+        end = data.find('\n', pos)
+        if end == -1:
+            self._line += data[pos:]
+            return None, len(data)
+        line = data[pos:end]
+        if self._line:
+            line, self._line = self._line + line, ''
+        if line[-1:] == '\r':
+            line = line[:-1]
+        return line, end + 1
+
+    def _dataReceived_CHUNK_LENGTH(self, data, pos):
+        end = data.find('\n', pos)
+        if end != -1 and not self._line:
+            # The whole line is in data, the usual case. int() ignores the
+            # CR that is left at its end
+            line, pos = data[pos:end], end + 1
+        else:
+            line, pos = self._readLine(data, pos)
+            if line is None:
+                return pos
+        self.length = int(line.split(';', 1)[0], 16)
+        if self.length == 0:
+            self.state = 'TRAILER'
         else:
-            self._buffer = data
-            return ''
+            self.state = 'BODY'
+        return pos
 
-    def _dataReceived_CRLF(self, data):
-        if data.startswith('\r\n'):
+    def _dataReceived_CRLF(self, data, pos):
+        if not self._line and data.startswith('\r\n', pos):
             self.state = 'CHUNK_LENGTH'
-            self._rawData('\r\n')
-            return data[2:]
-        else:
-            self._buffer = data
-            return ''
+            return pos + 2
+        line, pos = self._readLine(data, pos)
+        if line is not None:
+            if line:
+                raise _DataLoss("Chunk data is followed by %r instead of "
+                                "CRLF" % (line[:32],))
+            self.state = 'CHUNK_LENGTH'
+        return pos
 
-    def _dataReceived_TRAILER(self, data):
-        if data.startswith('\r\n'):
-            self._rawData('\r\n')
-            data = data[2:]
+    def _dataReceived_TRAILER(self, data, pos):
+        line, pos = self._readLine(data, pos)
+        # Trailer headers are passed on raw, the empty line ends the body
+        if line == '':
             self.state = 'FINISHED'
-            self.finishCallback(data)
-        else:
-            self._buffer = data
-        return ''
+        return pos
 
-    def _dataReceived_BODY(self, data):
-        if len(data) >= self.length:
-            chunk, data = data[:self.length], data[self.length:]
-            self._rawData(chunk)
+    def _dataReceived_BODY(self, data, pos):
+        end = min(len(data), pos + self.length)
+        self.length -= end - pos
+        if self.payloadCallback is not None:
+            if pos == 0 and end == len(data):
+                self._payload.append(data)
+            else:
+                self._payload.append(buffer(data, pos, end - pos))
+        if self.length == 0:
             self.state = 'CRLF'
-            return data
-        elif len(data) < self.length:
-            self.length -= len(data)
-            self._rawData(data)
-            return ''
+        return end
 
-    def _dataReceived_FINISHED(self, data):
+    def _dataReceived_FINISHED(self, data, pos):
         raise RuntimeError(
             "_ChunkedTransferDecoder.dataReceived called after last "
             "chunk was processed")
 
+    _dispatch = {
+        'CHUNK_LENGTH': _dataReceived_CHUNK_LENGTH,
+        'CRLF': _dataReceived_CRLF,
+        'TRAILER': _dataReceived_TRAILER,
+        'BODY': _dataReceived_BODY,
+        'FINISHED': _dataReceived_FINISHED,
+    }
 
     def dataReceived(self, data):
         """
         Interpret data from a request or response body which uses the
         I{chunked} Transfer-Encoding.
         """
-        data = self._buffer + data
-        self._buffer = ''
-        while data:
-            data = getattr(self, '_dataReceived_%s' % (self.state,))(data)
-
+        dispatch = self._dispatch
+        pos, length = 0, len(data)
+        if self.state == 'FINISHED':
+            self._dataReceived_FINISHED(data, pos)
+        while pos < length and self.state != 'FINISHED':
+            pos = dispatch[self.state](self, data, pos)
+        payload, self._payload = self._payload, []
+        if pos:
+            self.dataCallback(data if pos == length else data[:pos])
+        for chunk in payload:
+            self.payloadCallback(chunk)
+        if self.state == 'FINISHED':
+            self.finishCallback(data[pos:])
 
     def noMoreData(self):
         """
@@ -116,6 +166,14 @@ class ProxyHTTPClientParser(HTTPClientParser):
     def forwardData(self, data):
         """ Takes raw data and forwards it right to the serverProtocol """
         raise NotImplementedError("Method must be overridden")
+
+    def forwardPayload(self, data):
+        """
+        Called with the entity body, after any transfer encoding has been
+        removed. The same bytes are also passed to forwardData in raw form.
+        Chunked bodies are passed as buffer() slices, which are not copied
+        """
+        pass
     
     def lineReceived(self, line):
         """ Forwards the headers exactly as they arrive """
@@ -126,11 +184,26 @@ class ProxyHTTPClientParser(HTTPClientParser):
         
     def allHeadersReceived(self):
         HTTPClientParser.allHeadersReceived(self)
-        self.response.deliverBody(ProxyProtocol(self.forwardData))
+        decoder = getattr(self, 'bodyDecoder', None)
+        if isinstance(decoder, _RawChunkedTransferDecoder):
+            decoder.payloadCallback = self.forwardPayload
+            self.response.deliverBody(ProxyProtocol(self.forwardData))
+        else:
+            self.response.deliverBody(ProxyProtocol(self._forwardBody))
+
+    def _forwardBody(self, data):
+        """ Without a transfer encoding the raw body is the payload """
+        self.forwardData(data)
+        self.forwardPayload(data)
         
 class HTTP11WebProxyClientProtocol(protocol.Protocol):
     """ HTTP11 creates new parsers as they are needed over the HTTP1.1 stream"""
     parser = ProxyHTTPClientParser
+    _parser = None
+    # False once a request or response asked for the connection to close
+    persistent = True
+    # Set while the connection sits in an UpstreamConnectionPool
+    pool = poolKey = None
     
     def __init__(self, serverProtocol, con_uri):
         self.serverProtocol = serverProtocol
@@ -138,16 +211,50 @@ class HTTP11WebProxyClientProtocol(protocol.Protocol):
         self.connect_uri = con_uri
         
     def connectionMade(self):
+        # Paused by the browser's transport and anything else that cannot
+        # keep up with the response
+        self.sharedProducer = SharedProducer(self.transport)
         self.serverProtocol._resume(self)
         
     def connectionLost(self, reason):
         #print "HTTP11WebProxyClientProtocol Connection lost"
+        if self.pool is not None:
+            self.pool.removeConnection(self.poolKey, self)
         if self.serverProtocol is not None:
+            # A TLS transport does not close while it has a producer
+            self.serverProtocol._uncouple()
             self.serverProtocol.transport.loseConnection()
             self.serverProtocol = None
+
+    def isIdle(self):
+        """
+        True if the connection can be given another request: no response
+        is in progress, the server did not send anything unasked and
+        neither side asked to close it
+        """
+        return self.persistent and self._parser is None and not self._buffer
+
+    def attach(self, serverProtocol):
+        """ Reuses this connection for a new browser connection """
+        self.serverProtocol = serverProtocol
+        serverProtocol._resume(self)
+
+    def detach(self):
+        """ Called when the browser connection this was serving has gone """
+        self.serverProtocol = None
     
     def dataFromClientParser(self, data):
-        self.serverProtocol.transport.write(data)
+        # The rest of a response can still arrive after the browser left
+        # and this connection was told to close
+        if self.serverProtocol is not None:
+            self.serverProtocol.transport.write(data)
+
+    def payloadFromClientParser(self, data):
+        """
+        Called with the decoded response body, after dataFromClientParser.
+        It may be a buffer() rather than a string
+        """
+        pass
     
     def newRequest(self, request):
         """
@@ -156,6 +263,7 @@ class HTTP11WebProxyClientProtocol(protocol.Protocol):
         self.request = request
         self._parser = self.parser(request, self.finished)
         self._parser.forwardData = self.dataFromClientParser
+        self._parser.forwardPayload = self.payloadFromClientParser
         self._parser.makeConnection(self.transport)
         if self._buffer:
             self._parser.dataReceived(self._buffer)
@@ -176,8 +284,24 @@ class HTTP11WebProxyClientProtocol(protocol.Protocol):
         if rest:
             print "Spill-over data from the server:", len(rest)
             self._buffer += rest
+        self.persistent = self._responsePersistent()
         self._disconnectParser(None)
 
+    def _responsePersistent(self):
+        """ Whether the connection may be kept open after this response """
+        if not self.request.persistent:
+            return False
+        connHeaders = self._parser.connHeaders
+        conns = [x.lower() for x in
+                 connHeaders.getRawHeaders('connection', [])]
+        if any('close' in x for x in conns):
+            return False
+        response = getattr(self._parser, 'response', None)
+        if response is None:
+            return False
+        return response.version[1:] >= (1, 1) or \
+               any('keep-alive' in x for x in conns)
+
 class WebProxyClientFactory(protocol.ClientFactory):
     protocol = HTTP11WebProxyClientProtocol
     
@@ -240,7 +364,9 @@ class HTTPServerParser(HTTPParser):
 
 class WebProxyProtocol(HTTPParser):
     """ Creates a web proxy for HTTP and HTTPS """
-    certinfo = { 'key':'ca.key', 'cert':'ca.crt' }
+    # Next to this file, whatever the working directory
+    certinfo = { 'key':os.path.join(_HERE, 'ca.key'),
+                 'cert':os.path.join(_HERE, 'ca.crt') }
     serverParser = HTTPServerParser
     clientFactory = WebProxyClientFactory
     
@@ -274,8 +400,17 @@ class WebProxyProtocol(HTTPParser):
     def __init__(self):
         self.useSSL = False
         self.clientProtocol = None
+        self.upstreamKey = None
         self._rawDataBuffer = ''
         self._serverParser = None
+        self._lost = False
+        self._browserShare = self._upstreamShare = None
+
+    def connectionMade(self):
+        HTTPParser.connectionMade(self)
+        self.sharedProducer = SharedProducer(self.transport)
+        # Held paused until the upstream connection is ready
+        self._connecting = self.sharedProducer.share()
 
     def statusReceived(self, status):
         self.status = status
@@ -330,25 +465,76 @@ class WebProxyProtocol(HTTPParser):
         After the connection is made, all data should come in raw (body mode)
         and should be sent to an HTTPServerParser
         """
-        self.transport.pauseProducing()
+        self._connecting.pauseProducing()
         method, request_uri, _ = self.parseHttpStatus(self.status)
         
         self.useSSL = method == 'CONNECT'
         connect = reactor.connectTCP
         if self.useSSL:
             request_uri = 'https://' + request_uri
-            connect = lambda h,f,p: reactor.connectSSL(h, f, p,
-                                                     ssl.ClientContextFactory())
+            contexts = self.factory.clientContexts
+            connect = lambda h,p,f: reactor.connectSSL(h, p, f,
+                                            contexts.getContextFactory(h, p))
         if request_uri[:4].lower() != 'http':
             # TOFIX: Should check for host in the headers and not just
             # the status line
             raise ParseError("HTTP status line did not have an absolute uri")
         
         parsedUri = _URI.fromBytes(request_uri)
+        self.upstreamKey = (parsedUri.scheme, parsedUri.host, parsedUri.port)
+        HTTPParser.allHeadersReceived(self) # self.switchToBodyMode(None)
+
+        pool = getattr(self.factory, 'upstreamPool', None)
+        if pool is not None:
+            clientProtocol = pool.getConnection(self.upstreamKey)
+            if clientProtocol is not None:
+                clientProtocol.attach(self)
+                return
         print "New connection to:", parsedUri.host, parsedUri.port
         connect(parsedUri.host, parsedUri.port,
                 self.clientFactory(self, parsedUri.toBytes()))
-        HTTPParser.allHeadersReceived(self) # self.switchToBodyMode(None)
+
+    def connectionLost(self, reason):
+        """
+        The browser went away. An idle upstream connection is offered to
+        the pool, anything else is closed
+        """
+        HTTPParser.connectionLost(self, reason)
+        self._lost = True
+        if self.clientProtocol is not None:
+            self._releaseClient(self.clientProtocol)
+            self.clientProtocol = None
+
+    def _couple(self, clientProtocol):
+        """
+        Registers each side's transport as the producer for the other's, so
+        reading stops on one side while the other's write buffer is full
+        """
+        self._upstreamShare = clientProtocol.sharedProducer.share()
+        self.transport.registerProducer(self._upstreamShare, True)
+        self._browserShare = self.sharedProducer.share()
+        clientProtocol.transport.registerProducer(self._browserShare, True)
+
+    def _uncouple(self):
+        if self._upstreamShare is None:
+            return
+        # A transport that was lost has already dropped its producer
+        if not self.transport.disconnected:
+            self.transport.unregisterProducer()
+        self._upstreamShare.stopProducing()
+        if not self.clientProtocol.transport.disconnected:
+            self.clientProtocol.transport.unregisterProducer()
+        self._browserShare.stopProducing()
+        self._browserShare = self._upstreamShare = None
+
+    def _releaseClient(self, clientProtocol):
+        self._uncouple()
+        clientProtocol.detach()
+        pool = getattr(self.factory, 'upstreamPool', None)
+        if pool is not None:
+            pool.putConnection(self.upstreamKey, clientProtocol)
+        else:
+            clientProtocol.transport.loseConnection()
     
     def _resume(self, clientProtocol):
         """
@@ -356,7 +542,12 @@ class WebProxyProtocol(HTTPParser):
         Relay any extra data we received while waiting for the endpoint to
         connect, such as HTTP POST data
         """
+        if self._lost:
+            # The browser gave up while we were connecting
+            self._releaseClient(clientProtocol)
+            return
         self.clientProtocol = clientProtocol
+        self._couple(clientProtocol)
         
         self.createHttpServerParser()
         
@@ -375,25 +566,55 @@ class WebProxyProtocol(HTTPParser):
             self._rawDataBuffer = ''
         
         if self.useSSL:
-            self.transport.write('HTTP/1.0 200 Connection established\r\n\r\n')
-            ctx = ssl.DefaultOpenSSLContextFactory(
-                                    self.certinfo['key'], self.certinfo['cert'])
-            self.transport.startTLS(ctx)
-        self.transport.resumeProducing()
+            # Resumes once a certificate for the host is ready
+            d = self.factory.certAuthority.getContextFactory(
+                                                        self.upstreamKey[1])
+            d.addCallbacks(self._startTLS, self._certificateFailed)
+            return
+        self._connecting.resumeProducing()
+
+    def _startTLS(self, ctxFactory):
+        if self._lost:
+            return
+        self.transport.write('HTTP/1.0 200 Connection established\r\n\r\n')
+        self.transport.startTLS(ctxFactory)
+        self._connecting.resumeProducing()
+
+    def _certificateFailed(self, failure):
+        print "Could not create a certificate for", self.upstreamKey[1], \
+              failure.getErrorMessage()
+        self.transport.loseConnection()
         
 
 class MitmServerFactory(protocol.ServerFactory):
     protocol = WebProxyProtocol
 
+    def __init__(self, maxIdlePerHost=4, certCacheSize=256,
+                 preferECDHE=True):
+        self.upstreamPool = UpstreamConnectionPool(
+                                            maxIdlePerHost=maxIdlePerHost)
+        self.clientContexts = ClientContextCache(
+                            cipherList=ECDHE_CIPHERS if preferECDHE else None)
+        self.certAuthority = CertificateAuthority(
+                                        self.protocol.certinfo['key'],
+                                        self.protocol.certinfo['cert'],
+                                        cacheSize=certCacheSize)
+
+    def stopFactory(self):
+        self.upstreamPool.closeCachedConnections()
+
 def main():    
     parser = argparse.ArgumentParser(
                              description='Twisted Man-in-the-Middle Proxy')
     parser.add_argument('-p', '--port', default='8080',
                         help='Port to run the proxy server on.')
+    parser.add_argument('--pool-per-host', type=int, default=4,
+                        help='Idle upstream connections kept per host. '
+                             '0 disables connection reuse')
     args = parser.parse_args()
     args.port = int(args.port)
 
-    reactor.listenTCP(args.port, MitmServerFactory())
+    reactor.listenTCP(args.port, MitmServerFactory(args.pool_per_host))
     print "Proxy running on port", args.port
     reactor.run()
 
@@ -0,0 +1,172 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    import reactormon
+
+    # Print the stack of anything that blocks the reactor for 0.25 seconds
+    monitor = reactormon.LagMonitor(threshold=0.25)
+    monitor.start()
+
+    # Time every call of these methods into a Chrome trace. Open the file
+    # in chrome://tracing or https://ui.perfetto.dev
+    trace = reactormon.ChromeTrace('proxy.trace.json')
+    trace.wrap(WebProxyProtocol, 'dataReceived')
+    monitor = reactormon.LagMonitor(trace=trace)
+    ...
+    trace.close()
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+from twisted.internet import reactor, task
+
+from metrics import Histogram
+
+# Seconds between timer ticks, and the lag that counts as a stall
+DEFAULT_INTERVAL = 0.05
+DEFAULT_THRESHOLD = 0.5
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+               10)
+
+"""
+Measures how late a timer that should fire every interval seconds actually
+fires. That delay is how long the reactor was busy with something else.
+Every delay is observed in the lag Histogram, and one of threshold seconds
+or more counts as a stall and is printed.
+
+A watchdog thread checks on the reactor thread as well. Once the timer is
+more than threshold seconds overdue, the watchdog takes the reactor
+thread's stack, which shows the call that is blocking it while it is still
+running. The stack is printed with the stall, and is added to trace as an
+instant event if a ChromeTrace is given.
+
+"""
+class LagMonitor(object):
+    def __init__(self, interval=DEFAULT_INTERVAL, threshold=DEFAULT_THRESHOLD,
+                 trace=None, reactor=reactor):
+        self.interval = interval
+        self.threshold = threshold
+        self.trace = trace
+        self.stalls = 0
+        self.maxLag = 0.0
+        self.lag = Histogram(buckets=LAG_BUCKETS)
+        self._reactor = reactor
+        self._loop = None
+        self._watchdog = None
+        self._stopping = threading.Event()
+        self._beat = None
+        self._stack = None
+
+    def start(self):
+        """ Call from the reactor thread """
+        self._reactorThread = threading.current_thread().ident
+        self._beat = time.time()
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.clock = self._reactor
+        self._loop.start(self.interval, now=False)
+        self._watchdog = threading.Thread(target=self._watch,
+                                          name='LagMonitor')
+        self._watchdog.daemon = True
+        self._watchdog.start()
+        self._reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        self._stopping.set()
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def _tick(self):
+        now = time.time()
+        lag = max(0.0, now - self._beat - self.interval)
+        self._beat = now
+        self.lag.observe(lag)
+        self.maxLag = max(self.maxLag, lag)
+        stack, self._stack = self._stack, None
+        if lag < self.threshold:
+            return
+        self.stalls += 1
+        print "Reactor stalled for %.3f seconds" % lag
+        if stack is not None:
+            print "Blocked in:\n%s" % stack.rstrip()
+        if self.trace is not None:
+            self.trace.instant('reactor stall', now - lag,
+                               {'lag': lag, 'stack': stack})
+
+    def _watch(self):
+        while not self._stopping.wait(self.interval):
+            overdue = time.time() - self._beat - self.interval
+            if overdue < self.threshold or self._stack is not None:
+                continue
+            frame = sys._current_frames().get(self._reactorThread)
+            if frame is not None:
+                self._stack = ''.join(traceback.format_stack(frame))
+
+"""
+Writes Chrome trace events to path, in the JSON array format that
+chrome://tracing and Perfetto read. Events are written as they happen, so
+a trace of a proxy that was killed is still readable up to that point.
+Only the reactor thread may add events.
+
+"""
+class ChromeTrace(object):
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self._file = open(path, 'w')
+        self._file.write('[')
+        self._first = True
+
+    def _event(self, event):
+        if self._file is None:
+            return
+        event['pid'] = self.pid
+        event['tid'] = threading.current_thread().ident
+        self._file.write(('\n' if self._first else ',\n') + json.dumps(event))
+        self._first = False
+
+    def complete(self, name, start, duration, args=None):
+        """ A call of name that started at start and took duration seconds """
+        event = {'name': name, 'ph': 'X', 'ts': int(start * 1000000),
+                 'dur': int(duration * 1000000)}
+        if args:
+            event['args'] = args
+        self._event(event)
+
+    def instant(self, name, at, args=None):
+        event = {'name': name, 'ph': 'i', 's': 'p', 'ts': int(at * 1000000)}
+        if args:
+            event['args'] = args
+        self._event(event)
+
+    def wrap(self, cls, methodName, name=None):
+        """
+        Replaces cls.methodName with a version that adds a complete event
+        for every call, named Class.method unless name is given
+        """
+        original = getattr(cls, methodName)
+        name = name or '%s.%s' % (cls.__name__, methodName)
+        def traced(*args, **kwargs):
+            start = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.complete(name, start, time.time() - start)
+        traced.__name__ = methodName
+        setattr(cls, methodName, traced)
+
+    def close(self):
+        if self._file is not None:
+            self._file.write('\n]\n')
+            self._file.close()
+            self._file = None
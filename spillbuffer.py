@@ -0,0 +1,95 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    import spillbuffer
+
+    body = spillbuffer.SpillBuffer(threshold=1024*1024)
+    body.write(data)
+    ...
+    # Used as the block of a WarcRecord, the writer copies the chunks out
+    record = warcrecords.WarcResponseRecord(url=url, block=body)
+    body.close()
+"""
+
+import tempfile
+
+DEFAULT_SPILL_THRESHOLD = 1024 * 1024 # 1 MB
+INITIAL_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+"""
+Buffer for a captured HTTP message. Data is kept in a preallocated bytearray
+until it grows past threshold bytes, then everything is moved into an
+anonymous temporary file so memory use does not depend on the message size.
+
+Implements __len__ and iterchunks(), which is what WarcRecord._write_to and
+block_digest use to stream a block instead of requiring a string.
+
+"""
+class SpillBuffer(object):
+    def __init__(self, threshold=DEFAULT_SPILL_THRESHOLD, tmpdir=None):
+        self.threshold = threshold
+        self.tmpdir = tmpdir
+        self._length = 0
+        self._mem = bytearray(min(INITIAL_SIZE, threshold))
+        self._file = None
+
+    def __len__(self):
+        return self._length
+
+    def __nonzero__(self):
+        # An empty body is still a valid block
+        return True
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def write(self, data):
+        end = self._length + len(data)
+        if self._file is None and end > self.threshold:
+            self._spill()
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            # Overwrites the preallocated space in place; only grows the
+            # bytearray once the initial size is exceeded
+            self._mem[self._length:end] = data
+        self._length = end
+
+    def _spill(self):
+        self._file = tempfile.TemporaryFile(prefix='warcmitm-',
+                                            dir=self.tmpdir)
+        self._file.write(buffer(self._mem, 0, self._length))
+        self._mem = None
+
+    def iterchunks(self, size=CHUNK_SIZE):
+        """ Yields the buffered data in chunks of at most size bytes """
+        if self._file is None:
+            for start in xrange(0, self._length, size):
+                yield buffer(self._mem, start,
+                             min(size, self._length - start))
+            return
+        self._file.flush()
+        self._file.seek(0)
+        remaining = self._length
+        while remaining > 0:
+            chunk = self._file.read(min(size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+        self._file.seek(0, 2)
+
+    def getvalue(self):
+        return ''.join(str(c) for c in self.iterchunks())
+
+    def close(self):
+        """ Releases the memory or temporary file holding the data """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._mem = None
+        self._length = 0
@@ -0,0 +1,117 @@
+# Copyright (c) David Bern
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from connpool import UpstreamConnectionPool
+
+class FakeTransport(object):
+    connected = True
+    disconnecting = False
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def loseConnection(self):
+        if self.connected:
+            self.connected = False
+            self.protocol.connectionLost()
+
+"""
+Stands in for HTTP11WebProxyClientProtocol: idle, and removes itself from
+the pool when its connection is lost.
+
+"""
+class FakeProtocol(object):
+    pool = poolKey = None
+
+    def __init__(self):
+        self.transport = FakeTransport(self)
+
+    def isIdle(self):
+        return True
+
+    def connectionLost(self):
+        if self.pool is not None:
+            self.pool.removeConnection(self.poolKey, self)
+
+class UpstreamConnectionPoolTests(unittest.TestCase):
+    key = ('https', 'example.com', 443)
+    other = ('https', 'example.org', 443)
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def pool(self, **kwargs):
+        return UpstreamConnectionPool(reactor=self.clock, **kwargs)
+
+    def test_getReturnsNewest(self):
+        pool = self.pool()
+        a, b = FakeProtocol(), FakeProtocol()
+        pool.putConnection(self.key, a)
+        pool.putConnection(self.key, b)
+        self.assertIdentical(pool.getConnection(self.key), b)
+        self.assertIdentical(pool.getConnection(self.key), a)
+        self.assertIdentical(pool.getConnection(self.key), None)
+        self.assertEqual(pool._count, 0)
+        self.assertEqual(pool._idle, {})
+
+    def test_onePerHost(self):
+        pool = self.pool(maxIdlePerHost=1)
+        protocols = [FakeProtocol() for _ in xrange(3)]
+        for protocol in protocols:
+            pool.putConnection(self.key, protocol)
+            self.assertEqual(pool._count, 1)
+        self.assertFalse(protocols[0].transport.connected)
+        self.assertFalse(protocols[1].transport.connected)
+        self.assertIdentical(pool.getConnection(self.key), protocols[2])
+        self.assertEqual(pool._count, 0)
+        self.assertEqual(pool._idle, {})
+
+    def test_evictOldestAtMaxIdle(self):
+        pool = self.pool(maxIdle=2)
+        a, b, c = FakeProtocol(), FakeProtocol(), FakeProtocol()
+        pool.putConnection(self.key, a)
+        self.clock.advance(1)
+        pool.putConnection(self.other, b)
+        self.clock.advance(1)
+        pool.putConnection(self.key, c)
+        self.assertFalse(a.transport.connected)
+        self.assertEqual(pool._count, 2)
+        self.assertIdentical(pool.getConnection(self.key), c)
+        self.assertIdentical(pool.getConnection(self.other), b)
+        self.assertEqual(pool._count, 0)
+
+    def test_evictOnlyConnectionOfKey(self):
+        pool = self.pool(maxIdle=1)
+        a, b = FakeProtocol(), FakeProtocol()
+        pool.putConnection(self.key, a)
+        pool.putConnection(self.key, b)
+        self.assertFalse(a.transport.connected)
+        self.assertEqual(pool._count, 1)
+        self.assertIdentical(pool.getConnection(self.key), b)
+        self.assertEqual(pool._count, 0)
+
+    def test_idleTimeout(self):
+        pool = self.pool(idleTimeout=10)
+        a = FakeProtocol()
+        pool.putConnection(self.key, a)
+        self.clock.advance(10)
+        self.assertFalse(a.transport.connected)
+        self.assertIdentical(pool.getConnection(self.key), None)
+        self.assertEqual(pool._count, 0)
+
+    def test_lostWhileIdle(self):
+        pool = self.pool()
+        a = FakeProtocol()
+        pool.putConnection(self.key, a)
+        a.transport.loseConnection()
+        self.assertEqual(pool._count, 0)
+        self.assertEqual(pool._idle, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,79 @@
+# Copyright (c) David Bern
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.trial import unittest
+
+import warcrecords
+from hanzo.warctools import WarcRecord
+
+def urls(count):
+    return ['http://example.com/%d' % n for n in xrange(count)]
+
+"""
+read_record_at on a stream that a read_records loop is still using must
+leave the loop where it was.
+
+"""
+class ReadRecordAtTests(unittest.TestCase):
+    count = 6
+
+    def writeArchive(self, gzip):
+        path = self.mktemp()
+        with open(path, 'wb') as fh:
+            for url in urls(self.count):
+                record = warcrecords.WarcResponseRecord(url=url,
+                                                        block='x' * 5000)
+                record.write_to(fh, gzip=gzip)
+        return path
+
+    def offsets(self, path, gzip):
+        """ (offset, length) of each record, as a CDX index gives them """
+        stream = WarcRecord.open_archive(path, gzip=gzip)
+        offsets = [offset for offset, record, _ in
+                   stream.read_records(limit=None) if record]
+        stream.close()
+        ends = offsets[1:] + [os.path.getsize(path)]
+        return zip(offsets, [end - offset for offset, end in
+                             zip(offsets, ends)])
+
+    def interleave(self, gzip, withLength, mmap=False):
+        path = self.writeArchive(gzip and 'record')
+        index = self.offsets(path, gzip and 'record' or None)
+        self.assertEqual(len(index), self.count)
+        stream = WarcRecord.open_archive(path, gzip=gzip and 'record' or None,
+                                         mmap=mmap)
+        seen = []
+        for n, (offset, record, errors) in enumerate(
+                stream.read_records(limit=None)):
+            if not record:
+                self.assertEqual(errors, [])
+                break
+            self.assertEqual(record.errors, [])
+            seen.append(record.url)
+            # Look up every record, including ones not read yet
+            for at, (recordOffset, length) in enumerate(index):
+                found = stream.read_record_at(recordOffset,
+                                              length if withLength else None)
+                self.assertEqual(found.url, urls(self.count)[at])
+        stream.close()
+        self.assertEqual(seen, urls(self.count))
+
+    def test_plain(self):
+        self.interleave(False, False)
+
+    def test_plainWithLength(self):
+        self.interleave(False, True)
+
+    def test_gzip(self):
+        self.interleave(True, False)
+
+    def test_gzipWithLength(self):
+        self.interleave(True, True)
+
+    def test_mmap(self):
+        self.interleave(False, False, mmap=True)
@@ -0,0 +1,112 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    from tlsclient import ClientContextCache
+
+    contexts = ClientContextCache()
+    reactor.connectSSL(host, port, factory,
+                       contexts.getContextFactory(host, port))
+"""
+
+import time
+import weakref
+from collections import OrderedDict
+
+from OpenSSL import SSL
+from zope.interface import implementer
+
+from certauth import session_reused, ip_rx
+
+try:
+    from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+except ImportError:
+    # Twisted < 14 only uses getContext(), so sessions are not reused
+    IOpenSSLClientConnectionCreator = None
+
+# Key exchanges that avoid a fresh RSA or DH computation per handshake first
+ECDHE_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20:ECDHE+AES:DEFAULT:!aNULL:!eNULL:' \
+                '!MD5:!RC4'
+
+"""
+Context factory for one origin. It owns a client SSL.Context and remembers
+the last TLS session the origin gave us. New connections offer that session
+so the server can resume it rather than do a full handshake.
+The host name is also sent as SNI.
+Handshakes are counted on stats, which defaults to the factory itself. The
+time each connection's handshake finished is kept in stats.handshakeTimes,
+keyed by its SSL.Connection.
+
+"""
+class OriginContextFactory(object):
+    def __init__(self, host, port, cipherList=None, stats=None):
+        self.host = host
+        self.port = port
+        self.session = None
+        self.fullHandshakes = 0
+        self.resumedHandshakes = 0
+        self.stats = stats if stats is not None else self
+        if stats is None:
+            self.handshakeTimes = weakref.WeakKeyDictionary()
+        self._context = SSL.Context(SSL.SSLv23_METHOD)
+        self._context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+        self._context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        if cipherList:
+            self._context.set_cipher_list(cipherList)
+        self._context.set_info_callback(self._handshakeInfo)
+
+    def getContext(self):
+        return self._context
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = SSL.Connection(self._context, None)
+        if self.host and not ip_rx.match(self.host):
+            connection.set_tlsext_host_name(self.host)
+        if self.session is not None:
+            connection.set_session(self.session)
+        return connection
+
+    def _handshakeInfo(self, connection, where, ret):
+        # TLS 1.3 tickets arrive after the handshake. Reading one only
+        # reports a successful exit, so the session is refreshed on those too
+        if where & (SSL.SSL_CB_HANDSHAKE_DONE | SSL.SSL_CB_EXIT) and ret > 0:
+            self.session = connection.get_session()
+        handshakeTimes = self.stats.handshakeTimes
+        if not where & SSL.SSL_CB_HANDSHAKE_DONE or \
+           connection in handshakeTimes:
+            return
+        handshakeTimes[connection] = time.time()
+        if session_reused is not None and session_reused(connection):
+            self.stats.resumedHandshakes += 1
+        else:
+            self.stats.fullHandshakes += 1
+
+if IOpenSSLClientConnectionCreator is not None:
+    OriginContextFactory = implementer(IOpenSSLClientConnectionCreator)(
+                                                        OriginContextFactory)
+
+"""
+LRU cache of OriginContextFactory objects keyed by (host, port).
+fullHandshakes, resumedHandshakes and handshakeTimes cover all origins.
+
+"""
+class ClientContextCache(object):
+    def __init__(self, cacheSize=256, cipherList=None):
+        self.cacheSize = cacheSize
+        self.cipherList = cipherList
+        self.fullHandshakes = 0
+        self.resumedHandshakes = 0
+        self.handshakeTimes = weakref.WeakKeyDictionary()
+        self._cache = OrderedDict()
+
+    def getContextFactory(self, host, port):
+        key = (host.lower(), port)
+        ctxFactory = self._cache.pop(key, None)
+        if ctxFactory is None:
+            ctxFactory = OriginContextFactory(host, port, self.cipherList,
+                                              self)
+            while len(self._cache) >= self.cacheSize:
+                self._cache.popitem(last=False)
+        self._cache[key] = ctxFactory
+        return ctxFactory
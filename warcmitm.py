@@ -2,11 +2,26 @@
 
 
 import argparse
+import datetime
+import hashlib
+import os
+import sys
+import time
 
 from twisted.internet import reactor
 from twisted.web.client import _URI
 
+from hanzo.warctools.record import GzipRecordEncoder
+from hanzo.warctools.warc import make_metadata
+
+import metrics
+import reactormon
 import warcrecords
+from dedup import DigestIndex, DEFAULT_SLOTS
+from spillbuffer import SpillBuffer, DEFAULT_SPILL_THRESHOLD
+from warcwriter import WarcWriter, WarcOutputFile, WarcSegmentFile,\
+        DEFAULT_QUEUE_SIZE
+from workers import WorkerSupervisor, listenReusePort, reportStats
 from mitmtwisted import MitmServerFactory, WebProxyProtocol,\
         WebProxyClientFactory, HTTP11WebProxyClientProtocol
 
@@ -18,33 +33,176 @@ class WarcOutputSingleton(object):
             cls._instance = super(WarcOutputSingleton, cls).__new__(cls, *args, **kwargs)
         return cls._instance
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, maxQueue=DEFAULT_QUEUE_SIZE,
+                 compressLevel=9, compressThreads=0, segments=None,
+                 rotateSize=None, rotateTime=None, cdxj=False):
+        """
+        Writes everything to filename, unless segments is given. Then that
+        many rotating segments are written at once, named after filename
+        without its .warc(.gz) extension. With cdxj, each WARC file gets a
+        CDXJ index next to it
+        """
         # Make sure init is not called more than once
         try:
-            self.__fo
+            self.__writer
         except AttributeError:
             if filename is None:
                 filename = "out.warc.gz"
                 print "WarcOutput was not given a filename. Using", filename
             self.use_gzip = filename.endswith('.gz')
-            self.__fo = open(filename, 'wb')
-            record = warcrecords.WarcinfoRecord()
-            record.write_to(self.__fo, gzip=self.use_gzip)
+            encoder = GzipRecordEncoder(level=compressLevel)
+            if segments:
+                prefix = filename.rsplit('.warc', 1)[0]
+                outputs = [WarcSegmentFile(prefix, self.use_gzip, rotateSize,
+                                           rotateTime, encoder, cdxj=cdxj)
+                           for _ in xrange(segments)]
+            else:
+                outputs = [WarcOutputFile(filename, encoder, cdxj)]
+            self.__writer = WarcWriter(outputs, maxQueue, encoder=encoder,
+                                       compressThreads=compressThreads)
+            self.__writer.start()
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          self.__writer.stop)
 
-    # Write a given record to the output file
+    # Queue a given record to be written to the output file
+    # Returns a Deferred that fires once the record has been written
     def write_record(self, record):
-        record.write_to(self.__fo, gzip=self.use_gzip)
-        
+        return self.__writer.write_record(record)
+
+    # Producers are paused while the writer queue is full
+    def registerProducer(self, producer):
+        self.__writer.registerProducer(producer)
+
+    def unregisterProducer(self, producer):
+        self.__writer.unregisterProducer(producer)
+
+    def stats(self):
+        return {'records': self.__writer.recordsWritten,
+                'bytes': self.__writer.bytesWritten,
+                'writeFailures': self.__writer.writeFailures,
+                'queued': self.__writer.pending}
+
+    def registerMetrics(self, registry):
+        writer = self.__writer
+        registry.counter('warcmitm_records_written_total',
+                         'Records written to WARC files',
+                         lambda: writer.recordsWritten)
+        registry.counter('warcmitm_record_bytes_written_total',
+                         'Bytes of records written to WARC files',
+                         lambda: writer.bytesWritten)
+        registry.counter('warcmitm_write_failures_total',
+                         'Records that could not be written',
+                         lambda: writer.writeFailures)
+        registry.gauge('warcmitm_writer_queue_records',
+                       'Records waiting to be written',
+                       lambda: writer.pending)
+        registry.register(writer.writeSeconds, 'warcmitm_write_seconds',
+                          'Time to write a record, compression included '
+                          'without --compress-threads')
+        registry.register(writer.compressSeconds,
+                          'warcmitm_compress_seconds',
+                          'Time to compress a record on a compress thread')
+
+"""
+Counters for the proxy. Served in the Prometheus text format with
+--metrics-port. Bytes are counted as HTTP data, before TLS.
+
+"""
+class ProxyMetrics(metrics.MetricsRegistry):
+    def __init__(self, factory):
+        metrics.MetricsRegistry.__init__(self)
+        self.browserConnections = self.gauge(
+                'warcmitm_browser_connections', 'Open browser connections')
+        self.upstreamConnections = self.gauge(
+                'warcmitm_upstream_connections',
+                'Open upstream connections, idle pooled ones included')
+        self.browserBytesReceived = self.counter(
+                'warcmitm_browser_received_bytes_total',
+                'Bytes received from browsers')
+        self.browserBytesSent = self.counter(
+                'warcmitm_browser_sent_bytes_total', 'Bytes sent to browsers')
+        self.upstreamBytesReceived = self.counter(
+                'warcmitm_upstream_received_bytes_total',
+                'Bytes received from upstream servers')
+        self.upstreamBytesSent = self.counter(
+                'warcmitm_upstream_sent_bytes_total',
+                'Bytes sent to upstream servers')
+        self.connectFailures = self.counter(
+                'warcmitm_upstream_connect_failures_total',
+                'Upstream connections that could not be made')
+        ca, contexts = factory.certAuthority, factory.clientContexts
+        self.counter('warcmitm_browser_full_handshakes_total',
+                     'Full TLS handshakes with browsers',
+                     lambda: ca.fullHandshakes)
+        self.counter('warcmitm_browser_resumed_handshakes_total',
+                     'Resumed TLS handshakes with browsers',
+                     lambda: ca.resumedHandshakes)
+        self.counter('warcmitm_upstream_full_handshakes_total',
+                     'Full TLS handshakes with upstream servers',
+                     lambda: contexts.fullHandshakes)
+        self.counter('warcmitm_upstream_resumed_handshakes_total',
+                     'Resumed TLS handshakes with upstream servers',
+                     lambda: contexts.resumedHandshakes)
+        self.counter('warcmitm_dedup_lookups_total',
+                     'Payload digests looked up in the dedup index',
+                     lambda: self._dedupCount('lookups'))
+        self.counter('warcmitm_dedup_hits_total',
+                     'Responses written as revisit records',
+                     lambda: self._dedupCount('hits'))
+
+    @staticmethod
+    def _dedupCount(name):
+        index = WarcHTTP11WebProxyClientProtocol.digestIndex
+        return getattr(index, name) if index is not None else 0
+
+# Phases of a transaction in a timing record, in the order they happen on a
+# new CONNECT tunnel: the browser's TLS handshake waits for the upstream
+# connection and its handshake. An upstream connection taken from the pool
+# was connected before the browser was accepted
+TIMING_PHASES = ('browser-accept', 'connect', 'upstream-connect',
+                 'upstream-tls-handshake', 'browser-tls-handshake',
+                 'request-sent', 'first-byte', 'last-byte', 'persisted')
+
+def format_time(t):
+    return datetime.datetime.utcfromtimestamp(t).strftime(
+                                                    '%Y-%m-%dT%H:%M:%S.%fZ')
+
 def _copy_attrs(to, frum, attrs):
     map(lambda a: setattr(to, a, getattr(frum, a)), attrs)
 
-class WarcHTTP11WebProxyClientProtocol(HTTP11WebProxyClientProtocol):    
+class WarcHTTP11WebProxyClientProtocol(HTTP11WebProxyClientProtocol):
+    # Responses larger than this many bytes are spilled to a temporary file
+    spillThreshold = DEFAULT_SPILL_THRESHOLD
+    # DigestIndex of payloads already archived. None disables deduplication
+    digestIndex = None
+    # ProxyMetrics of the server factory, set by WarcWebProxyClientFactory
+    metrics = None
+    # Write a metadata record with the TIMING_PHASES of each transaction
+    timingRecords = False
+    _bodyBuffer = None
+    _timings = _timingServer = None
+    connectedAt = None
+    _requests = 0
+
+    def _startCapture(self):
+        self._bodyBuffer = SpillBuffer(self.spillThreshold)
+        # Digests are updated as data arrives so the writer never re-reads
+        # the block. The block is the raw response, the payload is the
+        # entity body with any chunked encoding removed
+        self._blockHash = hashlib.sha1()
+        self._payloadHash = hashlib.sha1()
+        self._payloadLength = 0
+
     def dataFromClientParser(self, data):
-        try:
-            self._bodyBuffer += data
-        except AttributeError:
-            self._bodyBuffer = data
+        if self._bodyBuffer is None:
+            self._startCapture()
+        self._bodyBuffer.write(data)
+        self._blockHash.update(data)
         HTTP11WebProxyClientProtocol.dataFromClientParser(self, data)
+
+    def payloadFromClientParser(self, data):
+        self._payloadHash.update(data)
+        self._payloadLength += len(data)
     
     def getRecordUri(self):
         req_uri = _URI.fromBytes(self.request.uri)
@@ -57,21 +215,158 @@ class WarcHTTP11WebProxyClientProtocol(HTTP11WebProxyClientProtocol):
         return con_uri.toBytes()
     
     def finished(self, rest):
+        timings = self._finishTimings() if self._timings is not None else None
         # Write out Response record to WARC
-        record = warcrecords.WarcResponseRecord(url=self.getRecordUri(),
-                                                block=self._bodyBuffer)
-        self._bodyBuffer = ''
-        WarcOutputSingleton().write_record(record)
+        if self._bodyBuffer is None:
+            self._startCapture()
+        body, self._bodyBuffer = self._bodyBuffer, None
+        payloadDigest = warcrecords.format_digest(self._payloadHash)
+        # Empty payloads are not worth a revisit record
+        dedup = self.digestIndex is not None and self._payloadLength > 0
+        original = self.digestIndex.get(payloadDigest) if dedup else None
+        if original is None:
+            record = warcrecords.WarcResponseRecord(url=self.getRecordUri(),
+                    block=body,
+                    block_digest=warcrecords.format_digest(self._blockHash),
+                    payload_digest=payloadDigest)
+        else:
+            refersTo, refersToUri, refersToDate = original
+            record = warcrecords.WarcRevisitRecord(url=self.getRecordUri(),
+                    block=warcrecords.http_head(body), refers_to=refersTo,
+                    refers_to_uri=refersToUri, refers_to_date=refersToDate,
+                    payload_digest=payloadDigest)
+        d = WarcOutputSingleton().write_record(record)
+        if dedup and original is None:
+            # Only payloads that made it to disk can be referred to
+            d.addCallback(self._indexRecord, payloadDigest)
+        if timings is not None:
+            d.addCallback(self._writeTimings, timings, self._requests)
+        d.addErrback(self._writeFailed)
+        d.addBoth(lambda _: body.close())
         HTTP11WebProxyClientProtocol.finished(self, rest)
+
+    def _indexRecord(self, result, payloadDigest):
+        record = result[0]
+        self.digestIndex.put(payloadDigest, record.id, record.url,
+                             record.date)
+        return result
+
+    def _writeFailed(self, failure):
+        print "Failed to write record:", failure.getErrorMessage()
+
+    def makeConnection(self, transport):
+        HTTP11WebProxyClientProtocol.makeConnection(self,
+                metrics.CountingTransport(transport,
+                                          self.metrics.upstreamBytesSent))
+
+    def dataReceived(self, data):
+        self.metrics.upstreamBytesReceived.value += len(data)
+        if self._timings is not None and 'first-byte' not in self._timings:
+            self._timings['first-byte'] = time.time()
+        HTTP11WebProxyClientProtocol.dataReceived(self, data)
+
+    def connectionMade(self):
+        self.connectedAt = time.time()
+        self.metrics.upstreamConnections.inc()
+        HTTP11WebProxyClientProtocol.connectionMade(self)
+        self._writerShare = self.sharedProducer.share()
+        WarcOutputSingleton().registerProducer(self._writerShare)
+
+    def connectionLost(self, reason):
+        self.metrics.upstreamConnections.dec()
+        WarcOutputSingleton().unregisterProducer(self._writerShare)
+        if self._bodyBuffer is not None:
+            self._bodyBuffer.close()
+            self._bodyBuffer = None
+        HTTP11WebProxyClientProtocol.connectionLost(self, reason)
     
     def newRequest(self, request):
+        self._requests += 1
+        if self.timingRecords:
+            server = self.serverProtocol
+            self._timings = {'browser-accept': server.acceptedAt,
+                             'connect': server.connectAt,
+                             'upstream-connect': self.connectedAt,
+                             # The request is written straight after this
+                             'request-sent': time.time()}
+            self._timingServer = server
         HTTP11WebProxyClientProtocol.newRequest(self, request)
 
+    def _finishTimings(self):
+        """ Adds the phases known once the response is complete """
+        timings, self._timings = self._timings, None
+        server, self._timingServer = self._timingServer, None
+        timings['last-byte'] = time.time()
+        factory = server.factory
+        # Handshakes are over by now. The times are looked up by the
+        # SSL.Connection of each side
+        if server.useSSL:
+            timings['browser-tls-handshake'] = \
+                factory.certAuthority.handshakeTimes.get(
+                                            server.transport.getHandle())
+        if self.connect_uri.startswith('https'):
+            timings['upstream-tls-handshake'] = \
+                factory.clientContexts.handshakeTimes.get(
+                                            self.transport.getHandle())
+        return timings
+
+    def _writeTimings(self, result, timings, requests):
+        record = result[0]
+        timings['persisted'] = time.time()
+        fields = ['%s: %s' % (phase, format_time(timings[phase]))
+                  for phase in TIMING_PHASES if timings.get(phase)]
+        fields.append('upstream-requests: %d' % requests)
+        metadata = make_metadata(
+                warcrecords.WarcRecord.make_warc_uuid(record.id + 'timings'),
+                datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                ('application/warc-fields', '\r\n'.join(fields) + '\r\n'),
+                concurrent_to=record.id, url=record.url)
+        d = WarcOutputSingleton().write_record(metadata)
+        d.addErrback(self._writeFailed)
+        return result
+
 class WarcWebProxyClientFactory(WebProxyClientFactory):
     protocol = WarcHTTP11WebProxyClientProtocol
 
+    def __init__(self, serverProtocol, con_uri):
+        WebProxyClientFactory.__init__(self, serverProtocol, con_uri)
+        self.metrics = serverProtocol.factory.metrics
+
+    def buildProtocol(self, addr):
+        protocol = WebProxyClientFactory.buildProtocol(self, addr)
+        protocol.metrics = self.metrics
+        return protocol
+
+    def clientConnectionFailed(self, connector, reason):
+        self.metrics.connectFailures.inc()
+        WebProxyClientFactory.clientConnectionFailed(self, connector, reason)
+
 class WarcWebProxyProtocol(WebProxyProtocol):
     clientFactory = WarcWebProxyClientFactory
+    acceptedAt = connectAt = None
+
+    def makeConnection(self, transport):
+        WebProxyProtocol.makeConnection(self,
+                metrics.CountingTransport(transport,
+                                          self.factory.metrics.browserBytesSent))
+
+    def connectionMade(self):
+        self.acceptedAt = time.time()
+        self.factory.metrics.browserConnections.inc()
+        WebProxyProtocol.connectionMade(self)
+
+    def allHeadersReceived(self):
+        # The CONNECT, or the head of the first plain HTTP request
+        self.connectAt = time.time()
+        WebProxyProtocol.allHeadersReceived(self)
+
+    def connectionLost(self, reason):
+        self.factory.metrics.browserConnections.dec()
+        WebProxyProtocol.connectionLost(self, reason)
+
+    def dataReceived(self, data):
+        self.factory.metrics.browserBytesReceived.value += len(data)
+        WebProxyProtocol.dataReceived(self, data)
     
     def dataFromServerParser(self, data):
         WebProxyProtocol.dataFromServerParser(self, data)
@@ -83,18 +378,170 @@ class WarcWebProxyProtocol(WebProxyProtocol):
 class WarcMitmServerFactory(MitmServerFactory):
     protocol = WarcWebProxyProtocol
 
+    def __init__(self, *args, **kwargs):
+        MitmServerFactory.__init__(self, *args, **kwargs)
+        self.metrics = ProxyMetrics(self)
+
+    def stats(self):
+        stats = WarcOutputSingleton().stats()
+        stats.update({
+            'browserFullHandshakes': self.certAuthority.fullHandshakes,
+            'browserResumedHandshakes': self.certAuthority.resumedHandshakes,
+            'upstreamFullHandshakes': self.clientContexts.fullHandshakes,
+            'upstreamResumedHandshakes':
+                                    self.clientContexts.resumedHandshakes})
+        index = WarcHTTP11WebProxyClientProtocol.digestIndex
+        if index is not None:
+            stats.update({'dedupLookups': index.lookups,
+                          'dedupHits': index.hits,
+                          'dedupEntries': len(index)})
+        return stats
+
+def traceProxy(trace):
+    """ Adds the reactor callbacks of the proxy and writer to trace """
+    for cls, methodName in [(WarcWebProxyProtocol, 'dataReceived'),
+                            (WarcWebProxyProtocol, 'allHeadersReceived'),
+                            (WarcHTTP11WebProxyClientProtocol, 'dataReceived'),
+                            (WarcHTTP11WebProxyClientProtocol, 'finished'),
+                            (WarcOutputSingleton, 'write_record'),
+                            (WarcWriter, '_written')]:
+        trace.wrap(cls, methodName)
+
+def workerFilename(filename, workerId):
+    """ out.warc.gz becomes out-worker3.warc.gz for worker 3 """
+    parts = filename.rsplit('.warc', 1)
+    return '%s-worker%d.warc%s' % (parts[0], workerId,
+                                   parts[1] if len(parts) > 1 else '')
+
+def supervise(args):
+    """
+    Runs args.workers copies of this script, each with a --worker-id, and
+    restarts any that exit
+    """
+    command = [sys.executable, '-u', os.path.abspath(sys.argv[0])] + \
+              sys.argv[1:]
+    supervisor = WorkerSupervisor(args.workers,
+                                  lambda n: command + ['--worker-id', str(n)])
+    supervisor.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    print "Supervising", args.workers, "workers on port", args.port
+    reactor.run()
+
 def main():    
     parser = argparse.ArgumentParser(
                              description='Warc Twisted Man-in-the-Middle Proxy')
     parser.add_argument('-p', '--port', default='8080',
                         help='Port to run the proxy server on.')
     parser.add_argument('-f', '--file', default='out.warc.gz',
-                        help='WARC file to output to')
+                        help='WARC file to output to. With rotation, the '
+                             'prefix of the segment names')
+    parser.add_argument('--rotate-size', type=int, default=None,
+                        help='Start a new WARC segment after this many bytes')
+    parser.add_argument('--rotate-time', type=int, default=None,
+                        help='Start a new WARC segment after this many '
+                             'seconds')
+    parser.add_argument('--segments', type=int, default=None,
+                        help='Number of WARC segments written at once. '
+                             'Implied to be 1 by --rotate-size/--rotate-time')
+    parser.add_argument('--spill-threshold', type=int,
+                        default=DEFAULT_SPILL_THRESHOLD,
+                        help='Response size in bytes above which the body is '
+                             'buffered in a temporary file instead of memory')
+    parser.add_argument('--write-queue', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='Number of records waiting to be written before '
+                             'upstream connections are paused')
+    parser.add_argument('--compress-level', type=int, default=9,
+                        choices=range(1, 10),
+                        help='zlib compression level for .gz output')
+    parser.add_argument('--compress-threads', type=int, default=0,
+                        help='Threads compressing records of up to 1 MB in '
+                             'parallel. 0 compresses on the writer thread')
+    parser.add_argument('--pool-per-host', type=int, default=4,
+                        help='Idle upstream connections kept per host. '
+                             '0 disables connection reuse')
+    parser.add_argument('--cdxj', action='store_true',
+                        help='Write a CDXJ index next to each WARC file')
+    parser.add_argument('--dedup-index', default=None,
+                        help='Digest index file. Responses whose payload is '
+                             'already in it are written as revisit records. '
+                             'With --workers, each worker keeps its own')
+    parser.add_argument('--dedup-slots', type=int, default=DEFAULT_SLOTS,
+                        help='Slots of a new digest index. Above the expected '
+                             'number of payloads, the index never has to grow')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of proxy processes sharing the port '
+                             'with SO_REUSEPORT. Each writes its own WARC '
+                             'segments')
+    parser.add_argument('--timing-records', action='store_true',
+                        help='Write a metadata record with the timing of '
+                             'each transaction, concurrent to its response')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve counters in the Prometheus text format '
+                             'on this local port. With --workers, worker N '
+                             'uses this port + N')
+    parser.add_argument('--stall-threshold', type=float,
+                        default=reactormon.DEFAULT_THRESHOLD,
+                        help='Print the stack of any call that blocks the '
+                             'reactor for this many seconds. 0 turns the '
+                             'check off')
+    parser.add_argument('--trace', default=None,
+                        help='Write a Chrome trace of reactor callbacks and '
+                             'stalls to this file')
+    parser.add_argument('--worker-id', type=int, default=None,
+                        help=argparse.SUPPRESS)
     args = parser.parse_args()
     args.port = int(args.port)
+    if args.workers > 1 and args.worker_id is None:
+        supervise(args)
+        return
+    WarcHTTP11WebProxyClientProtocol.spillThreshold = args.spill_threshold
+    WarcHTTP11WebProxyClientProtocol.timingRecords = args.timing_records
 
-    reactor.listenTCP(args.port, WarcMitmServerFactory())
-    WarcOutputSingleton(args.file)
+    factory = WarcMitmServerFactory(args.pool_per_host)
+    if args.worker_id is not None:
+        listenReusePort(args.port, factory)
+        args.file = workerFilename(args.file, args.worker_id)
+        # Segment names carry a timestamp, so a restarted worker never
+        # overwrites the files of the one it replaces
+        args.segments = args.segments or 1
+        if args.dedup_index:
+            args.dedup_index += '-worker%d' % args.worker_id
+    else:
+        reactor.listenTCP(args.port, factory)
+    if args.segments is None and (args.rotate_size or args.rotate_time):
+        args.segments = 1
+    output = WarcOutputSingleton(args.file, args.write_queue,
+                        args.compress_level, args.compress_threads,
+                        args.segments, args.rotate_size, args.rotate_time,
+                        args.cdxj)
+    output.registerMetrics(factory.metrics)
+    trace = None
+    if args.trace:
+        if args.worker_id is not None:
+            args.trace += '-worker%d' % args.worker_id
+        trace = reactormon.ChromeTrace(args.trace)
+        traceProxy(trace)
+        reactor.addSystemEventTrigger('after', 'shutdown', trace.close)
+    if args.stall_threshold > 0:
+        monitor = reactormon.LagMonitor(threshold=args.stall_threshold,
+                                        trace=trace)
+        monitor.start()
+        factory.metrics.register(monitor.lag, 'warcmitm_reactor_lag_seconds',
+                                 'How late a reactor timer fired')
+        factory.metrics.counter('warcmitm_reactor_stalls_total',
+                                'Reactor lags over --stall-threshold',
+                                lambda: monitor.stalls)
+    if args.metrics_port is not None:
+        metricsPort = args.metrics_port + (args.worker_id or 0)
+        metrics.listenMetrics(metricsPort, factory.metrics)
+        print "Metrics on http://127.0.0.1:%d/metrics" % metricsPort
+    if args.dedup_index:
+        index = DigestIndex(args.dedup_index, initialSlots=args.dedup_slots)
+        WarcHTTP11WebProxyClientProtocol.digestIndex = index
+        # After the writer has finished and indexed its last records
+        reactor.addSystemEventTrigger('after', 'shutdown', index.close)
+    if args.worker_id is not None:
+        reportStats(factory.stats)
     print "Proxy running on port", args.port
     reactor.run()
 
@@ -13,6 +13,12 @@ Usage:
     # To create a response record:
     record = warcrecords.WarcResponseRecord(url=url, block=block)
     warcrecords.WarcOutputSingleton().write_record(record)
+
+    # To record that a response repeated the payload of an earlier one,
+    # 'block' holding only the HTTP headers:
+    record = warcrecords.WarcRevisitRecord(url=url, block=block,
+                refers_to=original_id, refers_to_uri=original_url,
+                refers_to_date=original_date, payload_digest=digest)
 """
 
 import hashlib, uuid, base64
@@ -59,12 +65,48 @@ def make_warc_uuid(text=None):
     return "<urn:uuid:%s>"%uuid.UUID(hashlib.sha1(text).hexdigest()[0:32])
 WarcRecord.make_warc_uuid = make_warc_uuid
 
+# Formats a finished hashlib sha1 object as a base32 WARC digest
+def format_digest(hash):
+    return "sha1:%s" % base64.b32encode(hash.digest())
+
 # Overrides the block_digest method in WarcRecord to output base32 sha1
 def block_digest(self, content_buffer):
-    hash = base64.b32encode(hashlib.sha1(content_buffer).digest())
-    return "sha1:%s" % hash
+    block_hash = hashlib.sha1()
+    if hasattr(content_buffer, 'iterchunks'):
+        for chunk in content_buffer.iterchunks():
+            block_hash.update(chunk)
+    else:
+        block_hash.update(content_buffer)
+    return format_digest(block_hash)
 WarcRecord.block_digest = block_digest
 
+# Returns the status line and headers at the start of an HTTP message block
+def http_head(block, chunk_size=8192):
+    if not hasattr(block, 'iterchunks'):
+        end = block.find('\r\n\r\n')
+        return block[:end + 4] if end != -1 else block
+    head = ''
+    for chunk in block.iterchunks(chunk_size):
+        head += str(chunk)
+        end = head.find('\r\n\r\n')
+        if end != -1:
+            return head[:end + 4]
+    return head
+
+# Returns (status code, mime type) from an HTTP response head. Either can
+# be None
+def http_status_and_type(head):
+    lines = head.split('\r\n')
+    parts = lines[0].split(' ', 2)
+    status = parts[1] if len(parts) > 1 and parts[1].isdigit() else None
+    mime = None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-type':
+            mime = value.split(';', 1)[0].strip().lower() or None
+            break
+    return status, mime
+
 """
 Container to handle application/warc-fields as part of a warcinfo record
 
@@ -211,7 +253,8 @@ class WarcRequestRecord(WarcRecord):
 
 class WarcResponseRecord(WarcRecord):
     def __init__(self, id=None, date=None, url=None, block=None,
-                 concurrent_to=None, headers=None, defaults=True):
+                 concurrent_to=None, headers=None, defaults=True,
+                 block_digest=None, payload_digest=None):
         assert block is not None
         if headers is None:
             headers = []
@@ -229,6 +272,53 @@ class WarcResponseRecord(WarcRecord):
             headers.append((WarcRecord.URL, url))
         if concurrent_to:
             headers.append((WarcRecord.CONCURRENT_TO, concurrent_to))
+        # Digests computed while the response streamed in
+        if block_digest:
+            headers.append((WarcRecord.BLOCK_DIGEST, block_digest))
+        if payload_digest:
+            headers.append((WarcRecord.PAYLOAD_DIGEST, payload_digest))
 
         content = ('application/http;msgtype=response', block)
         super(WarcResponseRecord, self).__init__(headers=headers, content=content)
+
+"""
+A revisit record with the identical-payload-digest profile. The block holds
+only the HTTP response headers, the payload is the one in the record
+refers_to, which has the same payload_digest.
+
+"""
+class WarcRevisitRecord(WarcRecord):
+    def __init__(self, id=None, date=None, url=None, block=None,
+                 refers_to=None, refers_to_uri=None, refers_to_date=None,
+                 payload_digest=None, concurrent_to=None, headers=None,
+                 defaults=True,
+                 profile=WarcRecord.PROFILE_IDENTICAL_PAYLOAD_DIGEST):
+        assert block is not None
+        if headers is None:
+            headers = []
+        headers.append((WarcRecord.TYPE, WarcRecord.REVISIT))
+        if id:
+            headers.append((WarcRecord.ID, id))
+        elif defaults:
+            headers.append((WarcRecord.ID, self.make_warc_uuid()))
+        if date:
+            headers.append((WarcRecord.DATE, date))
+        elif defaults:
+            date = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            headers.append((WarcRecord.DATE, date))
+        if url:
+            headers.append((WarcRecord.URL, url))
+        if concurrent_to:
+            headers.append((WarcRecord.CONCURRENT_TO, concurrent_to))
+        headers.append((WarcRecord.PROFILE, profile))
+        if refers_to:
+            headers.append((WarcRecord.REFERS_TO, refers_to))
+        if refers_to_uri:
+            headers.append((WarcRecord.REFERS_TO_TARGET_URI, refers_to_uri))
+        if refers_to_date:
+            headers.append((WarcRecord.REFERS_TO_DATE, refers_to_date))
+        if payload_digest:
+            headers.append((WarcRecord.PAYLOAD_DIGEST, payload_digest))
+
+        content = ('application/http;msgtype=response', block)
+        super(WarcRevisitRecord, self).__init__(headers=headers, content=content)
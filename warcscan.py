@@ -0,0 +1,248 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    python warcscan.py crawl.warc.gz --task types
+    python warcscan.py crawl.warc.gz --task cdxj --processes 8 > crawl.cdxj
+
+    from warcscan import parallel_scan
+
+    # function must be a module level function so it can be pickled.
+    # It is called with each record, its offset and its length in the
+    # file, results come back in file order
+    def get_url(record, offset, length):
+        return record.url
+    for url in parallel_scan('crawl.warc.gz', get_url):
+        print url
+"""
+
+import argparse
+import base64
+import collections
+import hashlib
+import multiprocessing
+import os
+import sys
+import zlib
+
+import cdxj
+from hanzo.warctools import WarcRecord
+
+GZIP_MAGIC = '\x1f\x8b\x08'
+SEARCH_CHUNK_SIZE = 1024 * 1024
+PROBE_SIZE = 64 * 1024
+
+def is_warc_member(fh, offset):
+    """ True if a gzip member starts at offset and holds a WARC record """
+    fh.seek(offset)
+    data = fh.read(PROBE_SIZE)
+    if not data.startswith(GZIP_MAGIC):
+        return False
+    z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        head = z.decompress(data, 16)
+    except zlib.error:
+        return False
+    return head.startswith('WARC/')
+
+def find_member(fh, start, end):
+    """
+    Returns the offset of the first gzip member holding a WARC record that
+    starts at or after start and before end, or None
+    """
+    position = start
+    while position < end:
+        fh.seek(position)
+        # Overlap the chunks so a magic number across them is seen
+        data = fh.read(SEARCH_CHUNK_SIZE + len(GZIP_MAGIC) - 1)
+        if not data:
+            return None
+        found = data.find(GZIP_MAGIC)
+        while found != -1:
+            candidate = position + found
+            if candidate >= end:
+                return None
+            if is_warc_member(fh, candidate):
+                return candidate
+            found = data.find(GZIP_MAGIC, found + 1)
+        position += SEARCH_CHUNK_SIZE
+    return None
+
+def split_ranges(path, parts):
+    """ Splits the file into parts byte ranges of about the same size """
+    size = os.path.getsize(path)
+    step = max(1, -(-size // max(1, parts)))
+    return [(start, min(start + step, size)) for start in xrange(0, size, step)]
+
+def scan_range(path, start, end, function, lazy=False):
+    """
+    Calls function(record, offset, length) for each record whose gzip
+    member starts in start to end, and returns the results as a list.
+    The first member is found by resynchronizing on the next gzip header
+    that inflates to a WARC record.
+
+    A record's length is only known once the next record has been parsed,
+    so with lazy the function sees the headers only: the content was
+    skipped by then. Extra records in the same gzip member are passed
+    with the member's offset and length, and carry an error
+    """
+    results = []
+    with open(path, 'rb') as fh:
+        offset = find_member(fh, start, end)
+        if offset is None:
+            return results
+        stream = WarcRecord.open_archive(file_handle=fh, gzip='record',
+                                         lazy=lazy)
+        stream.seek(offset)
+        # (offset, records) of the member before the one just read
+        member = None
+        for offset, record, errors in stream.read_records(limit=None):
+            if offset is None:
+                # Another record in the same member, which has no offset
+                # of its own
+                if member is not None:
+                    member[1].append(record)
+                continue
+            if member is not None:
+                for previous in member[1]:
+                    results.append(function(previous, member[0],
+                                            offset - member[0]))
+                member = None
+            if not record or offset >= end:
+                break
+            member = (offset, [record])
+        if member is not None:
+            length = os.path.getsize(path) - member[0]
+            for previous in member[1]:
+                results.append(function(previous, member[0], length))
+    return results
+
+def _scan_part(args):
+    return scan_range(*args)
+
+def parallel_scan(path, function, processes=None, parts=None, lazy=False):
+    """
+    Maps function(record, offset, length) over every record of a
+    record-gzipped WARC with a pool of processes, and yields the results
+    in file order. The file is cut into parts byte ranges, by default
+    four per process so that slow ranges do not hold up the rest. With
+    lazy, function sees only the headers of each record, see scan_range
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if parts is None:
+        parts = processes * 4
+    jobs = [(path, start, end, function, lazy)
+            for start, end in split_ranges(path, parts)]
+    if processes <= 1:
+        for job in jobs:
+            for result in _scan_part(job):
+                yield result
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for results in pool.imap(_scan_part, jobs):
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Tasks for the command line. Each runs in the worker processes
+
+def task_types(record, offset, length):
+    return record.type
+
+def task_urls(record, offset, length):
+    return record.url
+
+def check_block_digest(record):
+    """
+    Compares the WARC-Block-Digest header with a digest of the content.
+    Returns an error tuple, or None if they match or there is no header.
+    The digest may be in base32, as this proxy writes it, or in hex
+    """
+    expected = record.get_header(WarcRecord.BLOCK_DIGEST)
+    if not expected:
+        return None
+    algorithm, _, value = expected.partition(':')
+    try:
+        block_hash = hashlib.new(algorithm.strip().lower())
+    except ValueError:
+        return ('unknown block digest algorithm', algorithm)
+    content = record.content[1] if record.content else ''
+    if hasattr(content, 'iterchunks'):
+        for chunk in content.iterchunks():
+            block_hash.update(chunk)
+    else:
+        block_hash.update(content)
+    digest = block_hash.digest()
+    value = value.strip()
+    if value.upper() != base64.b32encode(digest) and \
+       value.lower() != block_hash.hexdigest():
+        return ('block digest mismatch (is, claims)',
+                base64.b32encode(digest), value)
+    return None
+
+def task_validate(record, offset, length):
+    errors = list(record.errors)
+    digest_error = check_block_digest(record)
+    if digest_error is not None:
+        errors.append(digest_error)
+    return offset, record.type, errors
+
+class CdxjTask(object):
+    """ Picklable, so it can carry the file name to the workers """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, record, offset, length):
+        return cdxj.cdxj_line(record, self.filename, offset, length)
+
+def main():
+    parser = argparse.ArgumentParser(
+                        description='Scan a record-gzipped WARC in parallel')
+    parser.add_argument('file')
+    parser.add_argument('--task', default='types',
+                        choices=['types', 'urls', 'cdxj', 'validate'])
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Worker processes. Defaults to the CPU count')
+    parser.add_argument('--parts', type=int, default=None,
+                        help='Byte ranges to split the file into. Defaults '
+                             'to four per process')
+    args = parser.parse_args()
+
+    # Only the cdxj and validate tasks look at record content
+    lazy = args.task not in ('cdxj', 'validate')
+    if args.task == 'types':
+        counts = collections.Counter(parallel_scan(args.file, task_types,
+                                     args.processes, args.parts, lazy))
+        for record_type, count in counts.most_common():
+            print "%10d %s" % (count, record_type)
+    elif args.task == 'urls':
+        for url in parallel_scan(args.file, task_urls, args.processes,
+                                 args.parts, lazy):
+            if url:
+                print url
+    elif args.task == 'cdxj':
+        # The index is unsorted, like the file. Pipe it through sort
+        task = CdxjTask(os.path.basename(args.file))
+        for line in parallel_scan(args.file, task, args.processes,
+                                  args.parts, lazy):
+            if line:
+                sys.stdout.write(line)
+    elif args.task == 'validate':
+        records = bad = 0
+        for offset, record_type, errors in parallel_scan(args.file,
+                                task_validate, args.processes, args.parts,
+                                lazy):
+            records += 1
+            if errors:
+                bad += 1
+                print offset, record_type, errors
+        print "%d records, %d with errors" % (records, bad)
+
+if __name__ == '__main__':
+    main()
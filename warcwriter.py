@@ -0,0 +1,393 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    import warcwriter
+
+    writer = warcwriter.WarcWriter([warcwriter.WarcOutputFile('out.warc.gz')])
+    writer.start()
+
+    # From the reactor thread. The Deferred fires with (record, filename,
+    # offset, length) once the record is on disk
+    d = writer.write_record(record)
+
+    # Write to 3 segment files at once, each rotated after 1 GB or an hour
+    outputs = [warcwriter.WarcSegmentFile('crawl', maxSize=1024**3,
+                                          maxAge=3600) for _ in xrange(3)]
+    writer = warcwriter.WarcWriter(outputs)
+
+    # Keep a CDXJ index of every segment in segment.cdxj as it is written
+    outputs = [warcwriter.WarcSegmentFile('crawl', maxSize=1024**3,
+                                          cdxj=True)]
+
+    # Compress gzip members on 4 threads before they reach the writers
+    writer = warcwriter.WarcWriter(outputs, compressThreads=4)
+
+    # Seconds spent writing and, with compressThreads, compressing records
+    writer.writeSeconds.count, writer.compressSeconds.sum
+
+    # Transports registered with the writer are paused while the queue is full
+    writer.registerProducer(transport)
+    writer.unregisterProducer(transport)
+"""
+
+import itertools
+import os
+import socket
+import threading
+import time
+import Queue
+
+from twisted.internet import reactor, defer, threads
+from twisted.python import failure
+
+import cdxj
+import warcrecords
+from metrics import Histogram
+from hanzo.warctools.record import GzipRecordEncoder
+from spillbuffer import SpillBuffer, DEFAULT_SPILL_THRESHOLD
+
+DEFAULT_QUEUE_SIZE = 64
+
+"""
+A single WARC file. It is opened on first use and starts with a warcinfo
+record. Only the writer thread that owns it may call file(), indexRecord()
+and close().
+With cdxj set, a CDXJ line for each record is appended to filename.cdxj
+as the record is written, using the offset and length the writer already
+knows. Lines go out in capture order and the file is sorted when the WARC
+is closed, so a finished index can be searched straight away.
+
+"""
+class WarcOutputFile(object):
+    def __init__(self, filename, encoder=None, cdxj=False):
+        self.filename = filename
+        self.use_gzip = filename.endswith('.gz')
+        self.encoder = encoder
+        self.cdxj = cdxj
+        self.fo = None
+        self.index = None
+
+    def file(self):
+        """ Returns the file object the next record should be written to """
+        if self.fo is None:
+            self._open(self.filename)
+        return self.fo
+
+    def _open(self, filename):
+        self.fo = open(filename, 'wb')
+        if self.cdxj:
+            self.index = open(filename + '.cdxj', 'wb')
+        record = warcrecords.WarcinfoRecord(
+                                        filename=os.path.basename(filename))
+        record.write_to(self.fo, gzip=self.use_gzip, encoder=self.encoder)
+
+    def indexRecord(self, record, offset, length):
+        """ Adds the record just written at offset to the CDXJ index """
+        if self.index is None:
+            return
+        line = cdxj.cdxj_line(record, os.path.basename(self.filename),
+                              offset, length)
+        if line is not None:
+            self.index.write(line)
+
+    def close(self):
+        if self.fo is not None:
+            self.fo.close()
+            self.fo = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+            cdxj.sort_file(self.filename + '.cdxj')
+
+"""
+A series of WARC files named prefix-timestamp-serial-host.warc(.gz).
+Before each record the current segment is closed if it has reached maxSize
+bytes or is older than maxAge seconds, and the next one is started with its
+own warcinfo record. Serial numbers are shared by every segment series in
+the process, so several can be open in the same directory at once.
+
+"""
+class WarcSegmentFile(WarcOutputFile):
+    _serials = itertools.count()
+
+    def __init__(self, prefix, use_gzip=True, maxSize=None, maxAge=None,
+                 encoder=None, hostname=None, cdxj=False):
+        self.filename = None
+        self.prefix = prefix
+        self.use_gzip = use_gzip
+        self.encoder = encoder
+        self.cdxj = cdxj
+        self.fo = None
+        self.index = None
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.hostname = hostname if hostname else socket.gethostname()
+        self.opened = None
+
+    def makeFilename(self):
+        return '%s-%s-%05d-%s.warc%s' % (self.prefix,
+                time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+                next(self._serials), self.hostname,
+                '.gz' if self.use_gzip else '')
+
+    def file(self):
+        if self.fo is not None and self._full():
+            self.close()
+        if self.fo is None:
+            self.filename = self.makeFilename()
+            self._open(self.filename)
+            self.opened = time.time()
+        return self.fo
+
+    def _full(self):
+        if self.maxSize is not None and self.fo.tell() >= self.maxSize:
+            return True
+        if self.maxAge is not None and \
+           time.time() - self.opened >= self.maxAge:
+            return True
+        return False
+
+"""
+A compression job for one record. The gzip member is built in a SpillBuffer
+by a CompressorPool thread, done is set once member or failure is filled in.
+
+"""
+class CompressJob(object):
+    def __init__(self, record):
+        self.record = record
+        self.member = None
+        self.failure = None
+        self.done = threading.Event()
+
+"""
+Threads that encode records to complete gzip members ahead of the writer.
+Members of up to the encoder's chunk_size are made with zlib.compress,
+which releases the GIL, so they compress in parallel. Larger ones go
+through a compressobj, and Python 2's zlib lets only one thread at a time
+use those. The writer thread still appends members in order.
+The time each encode takes is observed in the compressSeconds Histogram.
+
+"""
+class CompressorPool(object):
+    def __init__(self, threads, encoder=None,
+                 spillThreshold=DEFAULT_SPILL_THRESHOLD, compressSeconds=None):
+        self.encoder = encoder if encoder else GzipRecordEncoder()
+        self.spillThreshold = spillThreshold
+        self.compressSeconds = compressSeconds
+        self.queue = Queue.Queue()
+        self.threads = []
+        for n in xrange(threads):
+            thread = threading.Thread(target=self._run,
+                                      name='WarcCompressor-%d' % n)
+            thread.daemon = True
+            self.threads.append(thread)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, record):
+        job = CompressJob(record)
+        self.queue.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            member = SpillBuffer(self.spillThreshold)
+            started = time.time()
+            try:
+                self.encoder.encode(job.record, member)
+            except Exception:
+                member.close()
+                job.failure = failure.Failure()
+            else:
+                job.member = member
+                if self.compressSeconds is not None:
+                    self.compressSeconds.observe(time.time() - started)
+            job.done.set()
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+"""
+Thread that takes (record, deferred) pairs off a queue and writes them to
+its WarcOutputFile. With a CompressorPool the items are (CompressJob,
+deferred) pairs instead and the finished members are copied out in the
+order they were taken off the queue.
+The deferred fires with (record, filename, offset, length) from the reactor
+thread. A None item stops the thread. The time each successful write takes,
+not counting the wait for its CompressJob, is observed in writeSeconds.
+
+"""
+class WarcWriterThread(threading.Thread):
+    def __init__(self, output, queue, encoder=None, name='WarcWriterThread',
+                 writeSeconds=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.output = output
+        self.queue = queue
+        self.encoder = encoder
+        self.writeSeconds = writeSeconds
+
+    def run(self):
+        # Create the file straight away rather than on the first record
+        self.output.file()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            job, d = item
+            if isinstance(job, CompressJob):
+                job.done.wait()
+            started = time.time()
+            try:
+                fo = self.output.file()
+                offset = fo.tell()
+                if isinstance(job, CompressJob):
+                    record = job.record
+                    self._writeMember(fo, job)
+                else:
+                    record = job
+                    record.write_to(fo, gzip=self.output.use_gzip,
+                                    encoder=self.encoder)
+                length = fo.tell() - offset
+            except Exception:
+                reactor.callFromThread(d.errback, failure.Failure())
+            else:
+                if self.writeSeconds is not None:
+                    self.writeSeconds.observe(time.time() - started)
+                try:
+                    self.output.indexRecord(record, offset, length)
+                except Exception:
+                    # The record is on disk, only its index line is missing
+                    print "Failed to index record:", failure.Failure(
+                                                        ).getErrorMessage()
+                reactor.callFromThread(d.callback, (record,
+                                self.output.filename, offset, length))
+        self.output.close()
+
+    def _writeMember(self, fo, job):
+        job.done.wait()
+        if job.failure is not None:
+            job.failure.raiseException()
+        try:
+            for chunk in job.member.iterchunks():
+                fo.write(chunk)
+        finally:
+            job.member.close()
+
+"""
+Reactor-side interface to one WarcWriterThread per output. The threads
+share a single queue, so records are spread over the outputs by whichever
+thread is free first.
+
+The queue is bounded by pausing rather than blocking: once maxQueue records
+are waiting, every registered producer is paused so no new responses arrive,
+and they are resumed after the queue has drained to lowWater. The reactor
+thread itself never waits on the disk.
+
+"""
+class WarcWriter(object):
+    def __init__(self, outputs, maxQueue=DEFAULT_QUEUE_SIZE, lowWater=None,
+                 encoder=None, compressThreads=0):
+        self.maxQueue = maxQueue
+        self.lowWater = maxQueue // 2 if lowWater is None else lowWater
+        self.pending = 0
+        self.paused = False
+        self.recordsWritten = 0
+        self.bytesWritten = 0
+        self.writeFailures = 0
+        # Without compressThreads, compression is part of the write time
+        self.writeSeconds = Histogram()
+        self.compressSeconds = Histogram()
+        self._producers = set()
+        self._queue = Queue.Queue()
+        self._threads = [WarcWriterThread(output, self._queue, encoder,
+                                          'WarcWriterThread-%d' % n,
+                                          self.writeSeconds)
+                         for n, output in enumerate(outputs)]
+        self._pool = None
+        use_gzip = all(output.use_gzip for output in outputs)
+        if use_gzip and compressThreads > 0:
+            self._pool = CompressorPool(compressThreads, encoder,
+                                        compressSeconds=self.compressSeconds)
+        self._stopped = None
+
+    def start(self):
+        if self._pool is not None:
+            self._pool.start()
+        for thread in self._threads:
+            thread.start()
+
+    def write_record(self, record):
+        """
+        Queues a record to be written. Returns a Deferred that fires with
+        (record, filename, offset, length) once it has been written
+        """
+        if self._stopped is not None:
+            return defer.fail(RuntimeError("WarcWriter has been stopped"))
+        d = defer.Deferred()
+        self.pending += 1
+        d.addBoth(self._written)
+        if self._pool is not None:
+            self._queue.put((self._pool.submit(record), d))
+        else:
+            self._queue.put((record, d))
+        if self.pending >= self.maxQueue and not self.paused:
+            self._pauseProducers()
+        return d
+
+    def _written(self, result):
+        self.pending -= 1
+        if isinstance(result, failure.Failure):
+            self.writeFailures += 1
+        else:
+            self.recordsWritten += 1
+            self.bytesWritten += result[3]
+        if self.paused and self.pending <= self.lowWater:
+            self._resumeProducers()
+        return result
+
+    def registerProducer(self, producer):
+        """ Adds an IPushProducer to be paused while the queue is full """
+        self._producers.add(producer)
+        if self.paused:
+            producer.pauseProducing()
+
+    def unregisterProducer(self, producer):
+        self._producers.discard(producer)
+
+    def _pauseProducers(self):
+        self.paused = True
+        for producer in self._producers:
+            producer.pauseProducing()
+
+    def _resumeProducers(self):
+        self.paused = False
+        for producer in self._producers:
+            producer.resumeProducing()
+
+    def stop(self):
+        """
+        Writes out any queued records and stops the threads. Returns a
+        Deferred that fires once the output files are closed
+        """
+        if self._stopped is None:
+            for thread in self._threads:
+                self._queue.put(None)
+            self._stopped = threads.deferToThread(self._join)
+        return self._stopped
+
+    def _join(self):
+        for thread in self._threads:
+            thread.join()
+        if self._pool is not None:
+            self._pool.stop()
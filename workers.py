@@ -0,0 +1,192 @@
+# Copyright (c) David Bern
+
+
+"""
+Usage:
+    import workers
+
+    # In each worker process, every one listening on the same port
+    workers.listenReusePort(8080, factory)
+    workers.reportStats(lambda: {'records': writer.recordsWritten})
+
+    # In the supervisor, which restarts workers that exit
+    supervisor = workers.WorkerSupervisor(4,
+                    lambda n: [sys.executable, 'warcmitm.py', '--worker-id',
+                               str(n)])
+    supervisor.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+"""
+
+import json
+import os
+import socket
+import sys
+
+from twisted.internet import reactor, protocol, task, defer
+from twisted.internet.error import ProcessExitedAlready
+
+# Workers write their stats as JSON lines to this file descriptor
+STATS_FD = 3
+STATS_INTERVAL = 10
+
+# Python 2 does not export the constant, 15 is its value on Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
+def listenReusePort(port, factory, backlog=50, interface='',
+                    reactor=reactor):
+    """
+    Like reactor.listenTCP, but the socket has SO_REUSEPORT set so several
+    processes can listen on the same port. The kernel spreads incoming
+    connections over them
+    """
+    if SO_REUSEPORT is None:
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+        # The reactor takes a duplicate of the descriptor
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET,
+                                       factory)
+    finally:
+        sock.close()
+
+def reportStats(collect, interval=STATS_INTERVAL, fd=STATS_FD):
+    """
+    Writes collect() as a JSON line to fd every interval seconds, for the
+    supervisor to read. Returns the LoopingCall
+    """
+    out = os.fdopen(fd, 'w', 0)
+    def report():
+        try:
+            out.write(json.dumps(collect()) + '\n')
+        except (IOError, OSError):
+            # The supervisor has gone away
+            loop.stop()
+    loop = task.LoopingCall(report)
+    loop.start(interval)
+    return loop
+
+"""
+ProcessProtocol for one worker. Its stdout and stderr are passed through
+prefixed with the worker ID, and the last stats line it sent is kept.
+
+"""
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, supervisor, workerId):
+        self.supervisor = supervisor
+        self.workerId = workerId
+        self.stats = {}
+        self._buffers = {}
+
+    def childDataReceived(self, childFD, data):
+        lines = (self._buffers.pop(childFD, '') + data).split('\n')
+        self._buffers[childFD] = lines.pop()
+        for line in lines:
+            if childFD == STATS_FD:
+                self._statsReceived(line)
+            else:
+                print "[worker %d] %s" % (self.workerId, line)
+
+    def _statsReceived(self, line):
+        try:
+            self.stats = json.loads(line)
+        except ValueError:
+            print "[worker %d] Bad stats line: %r" % (self.workerId, line)
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self, reason)
+
+"""
+Starts that many worker processes, each running the command returned by
+argv(workerId), and starts a replacement restartDelay seconds after one
+exits. The stats
+each worker reports on STATS_FD are summed and printed every statsInterval
+seconds. stop() sends SIGTERM to every worker and returns a Deferred that
+fires once they have all exited.
+
+"""
+class WorkerSupervisor(object):
+    def __init__(self, workers, argv, restartDelay=1,
+                 statsInterval=STATS_INTERVAL, reactor=reactor):
+        self.workers = workers
+        self.argv = argv
+        self.restartDelay = restartDelay
+        self.statsInterval = statsInterval
+        self.restarts = 0
+        self.processes = {}
+        self._reactor = reactor
+        self._restarting = {}
+        self._stopping = False
+        self._ended = []
+        self._statsLoop = None
+
+    def start(self):
+        for workerId in xrange(self.workers):
+            self._spawn(workerId)
+        if self.statsInterval:
+            self._statsLoop = task.LoopingCall(self.printStats)
+            self._statsLoop.clock = self._reactor
+            self._statsLoop.start(self.statsInterval, now=False)
+
+    def _spawn(self, workerId):
+        self._restarting.pop(workerId, None)
+        proto = WorkerProcessProtocol(self, workerId)
+        argv = self.argv(workerId)
+        self._reactor.spawnProcess(proto, argv[0], argv, env=os.environ,
+                        childFDs={0: 'w', 1: 'r', 2: 'r', STATS_FD: 'r'})
+        self.processes[workerId] = proto
+
+    def workerEnded(self, proto, reason):
+        workerId = proto.workerId
+        if self.processes.get(workerId) is proto:
+            del self.processes[workerId]
+        if self._stopping:
+            if not self.processes:
+                for d in self._ended:
+                    d.callback(None)
+                self._ended = []
+            return
+        print "Worker %d exited: %s. Restarting in %s seconds" % (
+                workerId, reason.getErrorMessage(), self.restartDelay)
+        self.restarts += 1
+        self._restarting[workerId] = self._reactor.callLater(
+                                self.restartDelay, self._spawn, workerId)
+
+    def stats(self):
+        """ Sums the last stats reported by each running worker """
+        totals = {}
+        for proto in self.processes.itervalues():
+            for key, value in proto.stats.iteritems():
+                if isinstance(value, (int, long, float)):
+                    totals[key] = totals.get(key, 0) + value
+        totals['workers'] = len(self.processes)
+        totals['restarts'] = self.restarts
+        return totals
+
+    def printStats(self):
+        stats = self.stats()
+        print "Stats:", ' '.join('%s=%s' % item for item in
+                                 sorted(stats.iteritems()))
+
+    def stop(self):
+        self._stopping = True
+        if self._statsLoop is not None and self._statsLoop.running:
+            self._statsLoop.stop()
+        for call in self._restarting.values():
+            call.cancel()
+        self._restarting.clear()
+        if not self.processes:
+            return defer.succeed(None)
+        for proto in self.processes.values():
+            try:
+                proto.transport.signalProcess('TERM')
+            except ProcessExitedAlready:
+                pass
+        d = defer.Deferred()
+        self._ended.append(d)
+        return d